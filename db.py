@@ -1,70 +1,347 @@
 # -*- coding: utf-8 -*-
+import contextlib
+import functools
+import itertools
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 import rethinkdb as r
 
+import metrics
+import site_cache
+import site_index
 import sitebot_config
+import snapshot
+import sqlite_db
+import storage
+import yolo_utils
+from storage import uppercase_site_name
+
+metrics.REGISTRY.describe('db', 'op', 'Time taken by YoloDB methods')
+
+BACKENDS = ('rethinkdb', 'sqlite')
+
+
+def create_db(config):
+    """Builds the storage backend picked with db_backend in the [bot]
+    section of the config, rethinkdb by default"""
+    backend = config.get('db_backend', 'rethinkdb')
+    if backend == 'sqlite':
+        return sqlite_db.SqliteYoloDB(
+            config.get('sqlite_path', 'yolobot.sqlite3')
+        )
+    if backend == 'rethinkdb':
+        return YoloDB(
+            config['db_host'],
+            config['db_name'],
+            int(config.get('db_pool_size', 8)),
+            int(config.get('db_idle_timeout', 300)),
+            config.get('site_cache', False),
+            config.get('snapshot_path')
+        )
+    raise ValueError('Unknown db backend: {}'.format(backend))
+
+
+class ConnectionPool(object):
+    """A bounded pool of RethinkDB connections.
+
+    Connections are handed out most recently used first. Connections that
+    sat idle for longer than `idle_timeout` seconds are closed instead of
+    reused, connections that raised a driver error are thrown away, and at
+    most `max_size` idle connections are kept around.
+    """
+    def __init__(self, host, db_name, max_size=8, idle_timeout=300):
+        self.host = host
+        self.db_name = db_name
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+
+        # (connection, time it was returned to the pool)
+        self._idle = []
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'connects': 0,
+            'failures': 0,
+            'expired': 0,
+        }
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    @staticmethod
+    def _is_open(conn):
+        try:
+            conn.check_open()
+        except r.errors.RqlDriverError:
+            return False
+        return True
 
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close(noreply_wait=False)
+        except r.errors.RqlDriverError:
+            pass
 
-def uppercase_site_name(func):
-    def wrapped(*args):
-        # args[0] = self
-        if len(args) > 2:
-            return func(args[0], args[1].upper(), *args[2:])
-        return func(args[0], args[1].upper())
-    return wrapped
-
-
-class YoloDB(object):
-    SITES_TABLE_NAME = 'sites'
+    def acquire(self):
+        """Returns a healthy connection, reusing an idle one if possible"""
+        now = time.time()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, released_at = self._idle.pop()
+
+            if now - released_at > self.idle_timeout:
+                self._count('expired')
+                self._close(conn)
+            elif self._is_open(conn):
+                self._count('hits')
+                return conn
+            else:
+                self._count('failures')
 
-    class AlreadyExistsError(Exception):
-        """Raised when trying to add a site that already exists in the db"""
-        pass
+        try:
+            conn = r.connect(self.host, db=self.db_name)
+        except r.errors.RqlDriverError:
+            self._count('failures')
+            raise
+        self._count('connects')
+        return conn
+
+    def release(self, conn, broken=False):
+        """Hands a connection back to the pool
+
+        :param broken: True if the connection raised a driver error, it will
+        be closed instead of being reused
+        """
+        if broken:
+            self._count('failures')
+        else:
+            with self._lock:
+                if len(self._idle) < self.max_size:
+                    self._idle.append((conn, time.time()))
+                    return
+        self._close(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except r.errors.RqlDriverError:
+            broken = True
+            raise
+        finally:
+            # also runs on GeneratorExit, when a generator holding the
+            # connection is closed
+            self.release(conn, broken)
+
+    def close(self):
+        """Closes all the idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+
+class YoloDB(storage.SiteStore):
+    """The RethinkDB backend"""
+    # answers reads from a snapshot file until the database is revalidated
+    snapshot = None
+
+    def __init__(self, host, db_name, pool_size=8, idle_timeout=300,
+                 cache=False, snapshot_path=None):
+        """
+        :param host: The RethinkDB host
+        :param db_name: The database the sites table lives in
+        :param pool_size: How many idle connections to keep
+        :param idle_timeout: Seconds before an idle connection is replaced
+        :param cache: Keep an in-memory copy of the sites table in sync with
+        a changefeed and answer reads from it
+        :param snapshot_path: Keep a snapshot of the sites table in this
+        file. If one is there at startup, reads are answered from it right
+        away while the database is set up and checked in the background.
+        Otherwise the first one is written in the background after setup, and
+        it's brought up to date on close.
+        """
+        self.host = host
+        self.db_name = db_name
+        self.pool = ConnectionPool(host, db_name, pool_size, idle_timeout)
+        self.indexes = set()
+        self.snapshot_path = snapshot_path
+        # the background writes and the one on close share a temp file
+        self._snapshot_lock = threading.Lock()
+        self.cache = site_cache.SiteCache(self) if cache else None
+
+        if snapshot_path:
+            self.snapshot = self.open_snapshot()
+        if self.snapshot is None:
+            self.setup()
+            if snapshot_path:
+                self._in_background(self._refresh_snapshot)
+        else:
+            self._in_background(self._revalidate)
+
+    @staticmethod
+    def _in_background(target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+    def setup(self):
+        """Creates the database, the sites table and its indexes if they
+        aren't there yet, and starts the site cache"""
+        with self.connection() as conn:
+            try:
+                r.db_create(self.db_name).run(conn)
+            except r.errors.RqlRuntimeError:
+                # db already exists
+                pass
 
-    class InvalidField(Exception):
-        """Raised when trying to set a value on an invalid field"""
-        pass
+            try:
+                r.db(self.db_name).table_create(
+                    self.SITES_TABLE_NAME, primary_key=self.PRIMARY_KEY
+                ).run(conn)
+            except r.errors.RqlRuntimeError:
+                # table already exists
+                pass
 
-    class InvalidType(Exception):
-        pass
+            self.indexes = self.create_indexes(conn)
 
-    def __init__(self, host, db_name):
-        self.host = host
-        self.db_name = db_name
+        if self.cache is not None:
+            self.cache.start()
 
-        conn = r.connect(host, db=db_name)
+    def open_snapshot(self):
+        """Maps the snapshot file, returns None if there's no usable one"""
+        try:
+            return snapshot.Snapshot(self.snapshot_path)
+        except (IOError, snapshot.Snapshot.InvalidSnapshot):
+            return None
+
+    def write_snapshot(self, sites=None):
+        """Writes the snapshot file from the given site documents, or from
+        the whole sites table"""
+        if sites is None:
+            with self.connection() as conn:
+                sites = list(r.table(self.SITES_TABLE_NAME).run(conn))
+        with self._snapshot_lock:
+            return snapshot.write(self.snapshot_path, sites)
+
+    def _refresh_snapshot(self, sites=None):
+        """write_snapshot for background threads and shutdown. If it fails
+        the next start is a cold one, or revalidates an older snapshot."""
         try:
-            r.db_create(db_name).run(conn)
-        except r.errors.RqlRuntimeError:
-            # db already exists
+            self.write_snapshot(sites)
+        except (r.errors.RqlError, IOError, OSError):
             pass
 
+    def _drop_snapshot(self):
+        """Stops answering reads from the snapshot and unmaps it"""
+        site_snapshot, self.snapshot = self.snapshot, None
+        if site_snapshot is not None:
+            site_snapshot.close()
+
+    def _revalidate(self):
+        """Sets the database up and replaces the snapshot with what's in the
+        table now. Reads go to the database (or the site cache) once this is
+        done, whether it worked or not."""
         try:
-            r.db(db_name).table_create(
-                self.SITES_TABLE_NAME, primary_key='name'
-            ).run(conn)
-        except r.errors.RqlRuntimeError:
-            # table already exists
+            self.setup()
+            self.write_snapshot()
+        except (r.errors.RqlError, IOError, OSError):
             pass
+        finally:
+            self._drop_snapshot()
 
-        r.table(self.SITES_TABLE_NAME).index_create('affils', multi=True)
-        r.table(self.SITES_TABLE_NAME).index_create('users', multi=True)
-        r.table(self.SITES_TABLE_NAME).index_create('allows', multi=True)
-        r.table(self.SITES_TABLE_NAME).index_create('banned', multi=True)
+    def create_indexes(self, conn):
+        """Creates a secondary index for every field in
+        sitebot_config.COLUMN_MAPPING (multi indexes for list fields) and
+        waits until all of them are ready.
 
-    def connection(self):
-        return r.connect(self.host, db=self.db_name)
+        :return: The names of the indexes on the sites table
+        """
+        table = r.db(self.db_name).table(self.SITES_TABLE_NAME)
+        for field, field_type in sitebot_config.COLUMN_MAPPING.items():
+            if field == self.PRIMARY_KEY:
+                continue
+            try:
+                table.index_create(field, multi=field_type == list).run(conn)
+            except r.errors.RqlRuntimeError:
+                # index already exists
+                pass
 
+        table.index_wait().run(conn)
+        return set(table.index_list().run(conn))
+
+    def connection(self):
+        """Checks a connection out of the pool for the duration of a with
+        block"""
+        return self.pool.connection()
+
+    def close(self):
+        """Stops the site cache and closes the pooled connections. The
+        snapshot is written from the cache if it was in sync, from the table
+        otherwise, so the next start has a current one."""
+        ready = self._cache_ready()
+        if self.cache is not None:
+            self.cache.stop()
+        if self.snapshot_path:
+            self._refresh_snapshot(self.cache.documents() if ready else None)
+        self._drop_snapshot()
+        self.pool.close()
+
+    def _cache_ready(self):
+        return self.cache is not None and self.cache.ready
+
+    def _cache_response(self, response):
+        """Applies a write response to the site cache right away, so reads
+        right after a write don't have to wait for the changefeed. The
+        snapshot no longer matches the table after a write, so it's dropped
+        if it was still in use."""
+        self._drop_snapshot()
+        if self.cache is not None:
+            self.cache.apply_response(response)
+        return response
+
+    @metrics.timed('db')
     @uppercase_site_name
     def add_site(self, site_name):
         """Adds a site to the database"""
         with self.connection() as conn:
-            result = r.table(self.SITES_TABLE_NAME).insert(
-                {'name': site_name}
-            ).run(conn)
+            result = self._cache_response(
+                r.table(self.SITES_TABLE_NAME).insert(
+                    {'name': site_name}, return_changes=True
+                ).run(conn)
+            )
 
             if result['inserted'] != 1:
                 raise self.AlreadyExistsError()
 
+    def _update(self, site_name, changes, return_changes=True):
+        """Runs an update on a single site in one round trip. The response
+        includes the old and new document under 'changes'.
+
+        :param return_changes: 'always' to get the document back even if the
+        update didn't change it
+        """
+        with self.connection() as conn:
+            return self._cache_response(
+                r.table(self.SITES_TABLE_NAME).get(site_name).update(
+                    changes, return_changes=return_changes
+                ).run(conn)
+            )
+
+    @staticmethod
+    def _list_field(site, field):
+        """The value of a list field, or an empty list if it isn't set yet"""
+        return site[field].default([])
+
+    @metrics.timed('db')
     @uppercase_site_name
     def add_value(self, site_name, field, value):
         """
@@ -72,48 +349,62 @@ class YoloDB(object):
         :param site_name: The name of the site that is being modified
         :param field: The name of the field to add the value to
         :param value: The value(s) to add to the given field
+        :return: The new contents of the field, or None if the site doesn't
+        exist
         """
-        value = self.validate_field(field, value)
-        with self.connection() as conn:
-            result = r.table(self.SITES_TABLE_NAME).get(
-                site_name
-            ).update({field: r.row[field].set_union(value)}).run(conn)
-
-            if result['errors'] > 0:
-                # field doesn't exist yet?
-                r.table(self.SITES_TABLE_NAME).get(site_name).update(
-                    {field: value}
-                ).run(conn)
-
-            return r.table(self.SITES_TABLE_NAME).get(site_name).run(
-                conn
-            )[field]
-
+        value = list(self.validate_field(field, value))
+        result = self._update(
+            site_name,
+            lambda site: {
+                field: self._list_field(site, field).set_union(value)
+            },
+            # the field comes back even if every value was already there
+            return_changes='always'
+        )
+
+        for change in result['changes']:
+            if change.get('new_val') is not None:
+                return change['new_val'][field]
+
+    @metrics.timed('db')
     @uppercase_site_name
     def remove_value(self, site_name, field, value):
         """
         If the field is a list field, remove one or more values from it.
-        If the field is a scalar, deletes the field from the row.
+        Scalar fields are left alone, see SiteStore.remove_value.
         :param site_name: The name of the site to remove the value from
         :param field: The field to operate on
         :param value: The value(s) that will be removed from the field
-        :return:
+        :return: The update response, including the new document under
+        'changes'
         """
-        with self.connection() as conn:
-            value = self.validate_field(field, value)
+        value = self.validate_field(field, value)
+
+        if sitebot_config.COLUMN_MAPPING[field] != list:
+            # an empty update, the response says if the site exists
+            return self._update(site_name, {})
 
-            return r.table(self.SITES_TABLE_NAME).get(site_name).update(
-                {field: r.row[field].set_difference(value)}
-            ).run(conn)
+        return self._update(
+            site_name,
+            lambda site: {
+                field: self._list_field(site, field).set_difference(
+                    list(value)
+                )
+            }
+        )
 
+    @metrics.timed('db')
     @uppercase_site_name
     def delete_site(self, site_name):
         """Attempts to delete a site from the database. Returns the response"""
         with self.connection() as conn:
-            return r.table(self.SITES_TABLE_NAME).get(site_name).delete().run(
-                conn
+            return self._cache_response(
+                r.table(self.SITES_TABLE_NAME).get(site_name).delete(
+                    return_changes=True
+                ).run(conn)
             )
 
+    @metrics.timed('db')
     @uppercase_site_name
     def get_site(self, site_name):
         """Looks up a site from the database
@@ -121,30 +412,167 @@ class YoloDB(object):
         :param site_name: The name of the site
         :rtype : object
         """
-        with self.connection() as conn:
-            return r.table(self.SITES_TABLE_NAME).get(site_name).run(conn)
+        if self._cache_ready():
+            return self.cache.get_site(site_name)
+        site_snapshot = self.snapshot
+        if site_snapshot is not None:
+            try:
+                return site_snapshot.get_site(site_name)
+            except ValueError:
+                # a write closed it in the meantime
+                pass
 
-    def list_sites(self):
-        """Returns all the sites in the database"""
         with self.connection() as conn:
-            return r.table(self.SITES_TABLE_NAME).pluck('name').order_by(
-                'name'
-            ).run(conn)
+            return r.table(self.SITES_TABLE_NAME).get(site_name).run(conn)
 
-    def search(self, field, value):
+    @staticmethod
+    def _page(query, page, page_size):
+        """Limits a query to a page of results, pages start at 1"""
+        if page is None:
+            return query
+        return query.skip((page - 1) * page_size).limit(page_size)
+
+    @staticmethod
+    def _page_of(rows, page, page_size):
+        """Same as _page, for results that are already in memory"""
+        if page is None:
+            return iter(rows)
+        start = (page - 1) * page_size
+        return itertools.islice(rows, start, start + page_size)
+
+    def _stream(self, query, name):
+        """Runs a query and yields its results as the cursor fetches them.
+        The connection stays checked out until the results are exhausted or
+        the generator is closed.
+
+        :param name: The time until the first batch arrives is recorded as
+        <name>_cursor in the db metrics
+        """
         with self.connection() as conn:
+            start = metrics.now()
+            cursor = query.run(conn)
+            metrics.REGISTRY.observe(
+                'db', '{}_cursor'.format(name), metrics.now() - start
+            )
+            try:
+                for row in cursor:
+                    yield row
+            finally:
+                if hasattr(cursor, 'close'):
+                    cursor.close()
+
+    @metrics.timed('db')
+    def list_sites(self, page=None, page_size=50):
+        """Returns a lazy iterator over the names of the sites in the
+        database, sorted by name
+
+        :param page: Only return this page of results, starting at 1
+        :param page_size: How many sites there are on a page
+        """
+        if self._cache_ready():
+            return self._page_of(self.cache.list_sites(), page, page_size)
+        site_snapshot = self.snapshot
+        if site_snapshot is not None:
+            try:
+                return self._page_of(
+                    site_snapshot.list_sites(), page, page_size
+                )
+            except ValueError:
+                # a write closed it in the meantime
+                pass
+
+        query = r.table(self.SITES_TABLE_NAME).order_by(
+            index=self.PRIMARY_KEY
+        ).pluck('name')
+        return self._stream(
+            self._page(query, page, page_size), 'list_sites'
+        )
+
+    @staticmethod
+    def _match_any(fields, pattern):
+        """Builds a filter for sites where any of the given list fields has a
+        value matching `pattern` (* is a wildcard)"""
+        def matches(site):
+            condition = None
+            for field in fields:
+                field_pattern = yolo_utils.uppercase_if_needed(field, pattern)
+                if site_index.is_pattern(field_pattern):
+                    regex = site_index.pattern_to_regex(field_pattern)
+                    field_condition = site[field].default([]).contains(
+                        lambda value: value.match(regex)
+                    )
+                else:
+                    field_condition = site[field].default([]).contains(
+                        field_pattern
+                    )
+                if condition is None:
+                    condition = field_condition
+                else:
+                    condition = condition | field_condition
+            return condition
+        return matches
+
+    @metrics.timed('db')
+    def search(self, field, value, page=None, page_size=50):
+        """Returns a lazy iterator over every site whose `field` is or
+        contains `value`, sorted by name. Fields with an index are looked up
+        through it, so the cost depends on the number of matches rather than
+        the size of the table.
+
+        For list fields `value` can contain * wildcards, and the field can be
+        site_index.ALL_FIELDS to search every list field. With the site cache
+        these are answered from its index, otherwise they need a table scan.
+
+        :param page: Only return this page of results, starting at 1
+        :param page_size: How many sites there are on a page
+        """
+        if field == site_index.ALL_FIELDS:
+            field_type = list
+        else:
             field_type = sitebot_config.COLUMN_MAPPING[field]
-            if field_type == list:
-                result = r.table(self.SITES_TABLE_NAME).filter(
-                    lambda site: site[field].contains(value)
-                ).order_by('name').run(conn)
-            else:
-                result = r.table(self.SITES_TABLE_NAME).filter(
-                    {field: field_type(value)}
-                ).order_by('name').run(conn)
+        if field_type != list:
+            value = field_type(value)
 
-            return [each for each in result]
+        if self._cache_ready():
+            return self._page_of(
+                self.cache.search(field, value, field_type), page, page_size
+            )
+        site_snapshot = self.snapshot
+        if site_snapshot is not None:
+            try:
+                return self._page_of(
+                    site_snapshot.search(field, value, field_type),
+                    page,
+                    page_size
+                )
+            except ValueError:
+                # a write closed it in the meantime
+                pass
+
+        table = r.table(self.SITES_TABLE_NAME)
+        # scans walk the primary index so results stream out in order, index
+        # lookups only sort their matches
+        ordered_table = table.order_by(index=self.PRIMARY_KEY)
+        if field == site_index.ALL_FIELDS:
+            query = ordered_table.filter(
+                self._match_any(site_index.LIST_FIELDS, value)
+            )
+        elif field_type == list and site_index.is_pattern(value):
+            query = ordered_table.filter(self._match_any((field,), value))
+        elif field == self.PRIMARY_KEY:
+            query = table.get_all(value).order_by('name')
+        elif field in self.indexes:
+            query = table.get_all(value, index=field).order_by('name')
+        elif field_type == list:
+            query = ordered_table.filter(
+                lambda site: site[field].contains(value)
+            )
+        else:
+            query = ordered_table.filter({field: value})
+
+        return self._stream(self._page(query, page, page_size), 'search')
 
+    @metrics.timed('db')
     @uppercase_site_name
     def set_value(self, site_name, field, value):
         """Sets the given value on the given field for the given site
@@ -154,29 +582,99 @@ class YoloDB(object):
         :param value: The value to set
         """
         value = self.validate_field(field, value)
+        return self._update(site_name, {field: value})
 
-        with self.connection() as conn:
-            return r.table(self.SITES_TABLE_NAME).get(site_name).update(
-                {field: value}
-            ).run(conn)
 
-    def validate_field(self, field, value):
+class AsyncYoloDB(object):
+    """Runs YoloDB calls on a bounded pool of worker threads so queries never
+    block the event loop. Every method takes the same arguments as its YoloDB
+    counterpart and returns a future for its result, so commands coming in at
+    the same time run side by side.
+
+    Identical get_site calls made while one is already running share its
+    query and its future instead of starting another one."""
+    AlreadyExistsError = storage.SiteStore.AlreadyExistsError
+    InvalidField = storage.SiteStore.InvalidField
+    InvalidType = storage.SiteStore.InvalidType
+
+    def __init__(self, yolodb, loop, max_workers=4):
         """
-        :param field: The field that is taking a new value
-        :param value: The value to be set on the given field
-        :return: The value passed in, cast to its expected type
+        :param yolodb: The YoloDB, or any other storage.SiteStore, to run the
+        queries with
+        :param loop: The event loop the futures belong to
+        :param max_workers: How many queries can run at the same time
         """
-        field_type = sitebot_config.COLUMN_MAPPING.get(field)
-        if not field_type:
-            raise self.InvalidField()
+        self.db = yolodb
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers)
+        # (method name, args) -> future of the call that is running
+        self._in_flight = {}
+        self.stats = {'coalesced': 0}
+
+    def _run(self, func, *args):
+        return self.loop.run_in_executor(
+            self.executor, functools.partial(func, *args)
+        )
+
+    def _run_shared(self, key, func, *args):
+        """Same as _run, but calls with the same key share the future of the
+        one that is still running"""
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            return future
+
+        future = self._in_flight[key] = self._run(func, *args)
+
+        def forget(_):
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+        future.add_done_callback(forget)
+        return future
+
+    def _write(self, func, site_name, *args):
+        # reads that start after a write must not join one that started
+        # before it
+        self._in_flight.pop(('get_site', site_name.upper()), None)
+        return self._run(func, site_name, *args)
 
-        if field_type != list:
-            value = ' '.join(value)
+    def add_site(self, site_name):
+        return self._write(self.db.add_site, site_name)
 
-        if field_type == int:
-            try:
-                return int(value)
-            except (ValueError, TypeError):
-                raise self.InvalidType('integer')
+    def add_value(self, site_name, field, value):
+        return self._write(self.db.add_value, site_name, field, value)
+
+    def remove_value(self, site_name, field, value):
+        return self._write(self.db.remove_value, site_name, field, value)
+
+    def delete_site(self, site_name):
+        return self._write(self.db.delete_site, site_name)
+
+    def get_site(self, site_name):
+        return self._run_shared(
+            ('get_site', site_name.upper()), self.db.get_site, site_name
+        )
+
+    def list_sites(self, page=None, page_size=50):
+        return self._run(self.db.list_sites, page, page_size)
+
+    def search(self, field, value, page=None, page_size=50):
+        return self._run(self.db.search, field, value, page, page_size)
+
+    def next_chunk(self, results, size):
+        """Fetches up to `size` more items from an iterator returned by
+        list_sites or search. An empty list means it is exhausted."""
+        return self._run(lambda: list(itertools.islice(results, size)))
+
+    def close_results(self, results):
+        """Releases the connection held by a partly read iterator"""
+        if hasattr(results, 'close'):
+            return self._run(results.close)
+
+    def set_value(self, site_name, field, value):
+        return self._write(self.db.set_value, site_name, field, value)
 
-        return value
+    def close(self):
+        """Waits for running queries and closes the pooled connections"""
+        self.executor.shutdown(wait=True)
+        self.db.close()
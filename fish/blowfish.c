@@ -317,28 +317,74 @@ int base64dec(char c)
 
 
 
-/* Returned string must be freed when done with it! */
-int encrypt_string(const char *key, const char *str, char *dest, int len)
+/* Keyed blowfish state. Build it once per key with blowfish_ctx_new and reuse
+ * it for every message, the key schedule is far more expensive than
+ * enciphering a short line. */
+typedef struct blowfish_ctx
 {
-	u_32bit_t left, right, bf_P[bf_N+2], bf_S[4][256];
-	unsigned char *p;
-	char *s, *d;
-	int i;
+	u_32bit_t bf_P[bf_N + 2];
+	u_32bit_t bf_S[4][256];
+} blowfish_ctx;
 
-	if ((!key) || (!key[0])) return 0;
 
-	/* Pad fake string with 8 bytes to make sure there's enough */
-	s = (char *) malloc(len + 9);
-	strncpy(s, str, len);
-	memset(s+len, 0, 9);
 
-	blowfish_init(key, strlen(key), bf_P, bf_S);
+/* Returned context must be freed with blowfish_ctx_free! */
+blowfish_ctx *blowfish_ctx_new(const char *key)
+{
+	blowfish_ctx *ctx;
+
+	if ((!key) || (!key[0])) return NULL;
+
+	ctx = (blowfish_ctx *) malloc(sizeof(blowfish_ctx));
+	if (!ctx) return NULL;
+
+	blowfish_init((const u_8bit_t *) key, strlen(key), ctx->bf_P, ctx->bf_S);
+	return ctx;
+}
+
+
+
+void blowfish_ctx_free(blowfish_ctx *ctx)
+{
+	if (!ctx) return;
+
+	ZeroMemory(ctx, sizeof(blowfish_ctx));	// blast the key schedule
+	free(ctx);
+}
+
+
+
+/* Both of these read str in place, only a trailing partial block is copied
+ * to a padded scratch block. They return the exact number of bytes written
+ * to dest (not counting the terminating NUL), or -1 without a context.
+ * Like the one-shot helpers, str is treated as a C string of at most len
+ * bytes. */
+int encrypt_string_ctx(blowfish_ctx *ctx, const char *str, char *dest, int len)
+{
+	u_32bit_t left, right;
+	unsigned char tail[8];
+	const unsigned char *p;
+	char *d;
+	int i, blocks;
+
+	if (!ctx) return -1;
 
-	p = s;
+	len = strnlen(str, len);
+	blocks = (len + 7) / 8;
 	d = dest;
 
-	while (*p)
+	while (blocks--)
 	{
+		p = (const unsigned char *) str;
+		if (!blocks && (len % 8))
+		{
+			/* Pad the last block with 0 bits */
+			ZeroMemory(tail, sizeof(tail));
+			memcpy(tail, str, len % 8);
+			p = tail;
+		}
+		str += 8;
+
 		left = ((*p++) << 24);
 		left += ((*p++) << 16);
 		left += ((*p++) << 8);
@@ -349,7 +395,7 @@ int encrypt_string(const char *key, const char *str, char *dest, int len)
 		right += ((*p++) << 8);
 		right += (*p++);
 
-		blowfish_encipher(&left, &right, bf_P, bf_S);
+		blowfish_encipher(&left, &right, ctx->bf_P, ctx->bf_S);
 
 		for (i = 0; i < 6; i++)
 		{
@@ -363,45 +409,125 @@ int encrypt_string(const char *key, const char *str, char *dest, int len)
 			left = (left >> 6);
 		}
 	}
-  
+
 	*d = 0;
-	memset(s, 0, len + 9);	// blast temporary buffer
-	free(s);
-	return 1;
+	ZeroMemory(tail, sizeof(tail));	// blast temporary buffer
+	return d - dest;
 }
 
 
 
-int decrypt_string(const char *key, const char *str, char *dest, int len)
+int decrypt_string_ctx(blowfish_ctx *ctx, const char *str, char *dest, int len)
 {
-	u_32bit_t left, right, bf_P[bf_N+2], bf_S[4][256];
-	char *p, *s, *d;
-	int i;
-
-	/* Pad encoded string with 0 bits in case it's bogus */
-	if ((!key) || (!key[0])) return 0;
-
-	s = (char *) malloc(len + 12);
-	strncpy(s, str, len);
-	memset(s+len, 0, 12);
+	u_32bit_t left, right;
+	char tail[12];
+	const char *p;
+	char *d;
+	int i, blocks;
 
-	blowfish_init((unsigned char *) key, strlen(key), bf_P, bf_S);
+	if (!ctx) return -1;
 
-	p = s;
+	len = strnlen(str, len);
+	blocks = (len + 11) / 12;
 	d = dest;
 
-	while (*p)
+	while (blocks--)
 	{
+		p = str;
+		if (!blocks && (len % 12))
+		{
+			/* Pad encoded string with 0 bits in case it's bogus */
+			ZeroMemory(tail, sizeof(tail));
+			memcpy(tail, str, len % 12);
+			p = tail;
+		}
+		str += 12;
+
 		right = 0L;
 		left = 0L;
 		for (i = 0; i < 6; i++) right |= (base64dec(*p++)) << (i * 6);
 		for (i = 0; i < 6; i++) left |= (base64dec(*p++)) << (i * 6);
-		blowfish_decipher(&left, &right, bf_P, bf_S);
+		blowfish_decipher(&left, &right, ctx->bf_P, ctx->bf_S);
 		for (i = 0; i < 4; i++) *d++ = (left & (0xff << ((3 - i) * 8))) >> ((3 - i) * 8);
 		for (i = 0; i < 4; i++) *d++ = (right & (0xff << ((3 - i) * 8))) >> ((3 - i) * 8);
 	}
 
+	/* Drop the NUL padding of the last block */
+	while (d > dest && !d[-1]) d--;
+
 	*d = 0;
-	free(s);
+	return d - dest;
+}
+
+
+
+/* One-shot helpers, these run the full key schedule on every call. */
+int encrypt_string(const char *key, const char *str, char *dest, int len)
+{
+	blowfish_ctx ctx;
+
+	if ((!key) || (!key[0])) return 0;
+
+	blowfish_init((const u_8bit_t *) key, strlen(key), ctx.bf_P, ctx.bf_S);
+	encrypt_string_ctx(&ctx, str, dest, len);
+	ZeroMemory(&ctx, sizeof(blowfish_ctx));
+	return 1;
+}
+
+
+
+int decrypt_string(const char *key, const char *str, char *dest, int len)
+{
+	blowfish_ctx ctx;
+
+	if ((!key) || (!key[0])) return 0;
+
+	blowfish_init((const u_8bit_t *) key, strlen(key), ctx.bf_P, ctx.bf_S);
+	decrypt_string_ctx(&ctx, str, dest, len);
+	ZeroMemory(&ctx, sizeof(blowfish_ctx));
+	return 1;
+}
+
+
+
+/* Batch helpers: count strings are packed back to back in src, the i-th one
+ * being lens[i] bytes long. Results are written back to back into dest, each
+ * one NUL terminated, and their lengths (without the NUL) go to out_lens.
+ * Each result gets a slot of 12 * ceil(lens[i] / 8) + 1 bytes when
+ * encrypting and 8 * ceil(lens[i] / 12) + 1 bytes when decrypting, dest
+ * must hold all of them. */
+int encrypt_batch_ctx(blowfish_ctx *ctx, const char *src, const int *lens,
+	int count, char *dest, int *out_lens)
+{
+	int i;
+
+	if (!ctx) return 0;
+
+	for (i = 0; i < count; i++)
+	{
+		out_lens[i] = encrypt_string_ctx(ctx, src, dest, lens[i]);
+		src += lens[i];
+		dest += ((lens[i] + 7) / 8) * 12 + 1;
+	}
+
+	return 1;
+}
+
+
+
+int decrypt_batch_ctx(blowfish_ctx *ctx, const char *src, const int *lens,
+	int count, char *dest, int *out_lens)
+{
+	int i;
+
+	if (!ctx) return 0;
+
+	for (i = 0; i < count; i++)
+	{
+		out_lens[i] = decrypt_string_ctx(ctx, src, dest, lens[i]);
+		src += lens[i];
+		dest += ((lens[i] + 11) / 12) * 8 + 1;
+	}
+
 	return 1;
 }
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Reloads modules only when their source changed since they were loaded, so
+!reload can keep whatever was built from the modules that didn't.
+
+A module also counts as changed when one of the modules it imports was
+reloaded, since it may hold on to that module's classes and functions.
+"""
+import hashlib
+import types
+
+# module name -> sha1 of the source it was loaded from
+_hashes = {}
+
+
+def source_hash(module):
+    path = module.__file__
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    with open(path, 'rb') as source_file:
+        return hashlib.sha1(source_file.read()).hexdigest()
+
+
+def track(*modules):
+    """Remembers the source the modules were loaded from. Modules that are
+    already tracked keep their hash, so this can run every time a module is
+    executed again."""
+    for module in modules:
+        if module.__name__ not in _hashes:
+            _hashes[module.__name__] = source_hash(module)
+
+
+def changed(module):
+    """Tells if the module's source changed since it was tracked, and
+    tracks the new source. For modules something else reloads."""
+    digest = source_hash(module)
+    if _hashes.get(module.__name__) == digest:
+        return False
+    _hashes[module.__name__] = digest
+    return True
+
+
+def imports(module):
+    """Names of the modules `module` imported"""
+    return set(
+        value.__name__ for value in vars(module).itervalues()
+        if isinstance(value, types.ModuleType)
+    )
+
+
+def reload_changed(modules, changed_names=()):
+    """Reloads the modules that changed, or import one that was reloaded.
+
+    :param modules: The modules to check, every module has to come after
+    the modules it imports
+    :param changed_names: Names of modules that were already reloaded
+    :return: The names of every module that was reloaded, including
+    `changed_names`
+    """
+    reloaded = set(changed_names)
+    for module in modules:
+        if changed(module) or imports(module) & reloaded:
+            reload(module)
+            _hashes[module.__name__] = source_hash(module)
+            reloaded.add(module.__name__)
+    return reloaded
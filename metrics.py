@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Counts and latency histograms for commands, database calls and the cipher.
+
+Every observation is a bisect into a fixed list of bucket bounds and a few
+additions under a lock, so it's cheap enough to leave on. Percentiles are
+estimated from the buckets. The whole registry can be rendered in the
+Prometheus text format.
+"""
+import bisect
+import functools
+import os
+import threading
+import timeit
+import types
+
+now = timeit.default_timer
+
+# upper bounds of the latency buckets, 100us doubling up to ~52s
+BUCKETS = tuple(0.0001 * 2 ** i for i in range(20))
+
+PREFIX = 'yolobot'
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'errors', 'total')
+
+    def __init__(self):
+        # the last bucket catches everything past BUCKETS[-1]
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+
+    def percentile(self, fraction):
+        """Estimates the latency below which `fraction` of the observations
+        fall, interpolating inside the bucket it lands in"""
+        if not self.count:
+            return 0.0
+
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1] * 2
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-1]
+
+
+class Registry(object):
+    """Histograms grouped in families, e.g. the 'db' family has one histogram
+    per YoloDB method. Other objects' stats dicts can be registered too, and
+    are exported as gauges."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        # family -> (label name, help text)
+        self.families = {}
+        # family -> label -> Histogram
+        self.histograms = {}
+        # name -> function returning a dict of numbers
+        self.stats = {}
+
+    def describe(self, family, label_name, help_text):
+        self.families[family] = (label_name, help_text)
+        self.histograms.setdefault(family, {})
+
+    def observe(self, family, label, seconds, error=False):
+        with self._lock:
+            histograms = self.histograms.setdefault(family, {})
+            histogram = histograms.get(label)
+            if histogram is None:
+                histogram = histograms[label] = Histogram()
+            histogram.observe(seconds, error)
+
+    def register_stats(self, name, get_stats):
+        """Exports the numbers in a stats dict as gauges named
+        yolobot_<name>_<key>. Registering a name again replaces it.
+
+        :param get_stats: A dict, or a function returning one
+        """
+        if isinstance(get_stats, dict):
+            stats = get_stats
+            get_stats = lambda: stats
+        self.stats[name] = get_stats
+
+    def summary(self, family):
+        """Yields (label, count, errors, p50, p95, p99) for every label of the
+        family that was observed, sorted by label"""
+        with self._lock:
+            histograms = sorted(self.histograms.get(family, {}).items())
+            for label, histogram in histograms:
+                yield (
+                    label,
+                    histogram.count,
+                    histogram.errors,
+                    histogram.percentile(0.5),
+                    histogram.percentile(0.95),
+                    histogram.percentile(0.99),
+                )
+
+    def render(self):
+        """Returns every metric in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            for family in sorted(self.histograms):
+                label_name, help_text = self.families.get(
+                    family, ('name', family)
+                )
+                name = '{}_{}_seconds'.format(PREFIX, family)
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} histogram'.format(name))
+                errors = []
+                for label, histogram in sorted(
+                        self.histograms[family].items()):
+                    label = '{}="{}"'.format(label_name, _escape(label))
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        cumulative += count
+                        lines.append('{}_bucket{{{},le="{:g}"}} {}'.format(
+                            name, label, bound, cumulative
+                        ))
+                    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                        name, label, histogram.count
+                    ))
+                    lines.append('{}_sum{{{}}} {!r}'.format(
+                        name, label, histogram.total
+                    ))
+                    lines.append('{}_count{{{}}} {}'.format(
+                        name, label, histogram.count
+                    ))
+                    errors.append((label, histogram.errors))
+
+                name = '{}_{}_errors_total'.format(PREFIX, family)
+                lines.append('# TYPE {} counter'.format(name))
+                for label, count in errors:
+                    lines.append('{}{{{}}} {}'.format(name, label, count))
+
+        for stats_name, get_stats in sorted(self.stats.items()):
+            for key, value in sorted(get_stats().items()):
+                if not isinstance(value, (int, long, float)):
+                    continue
+                name = '{}_{}_{}'.format(PREFIX, stats_name, key)
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {!r}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Writes the metrics to `path`. The file is replaced in one go, so
+        collectors never read a half written file."""
+        temp_path = '{}.tmp'.format(path)
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.rename(temp_path, path)
+
+
+def _escape(label):
+    return str(label).replace('\\', '\\\\').replace('"', '\\"')
+
+
+REGISTRY = Registry()
+
+
+def timed(family, label=None, registry=REGISTRY):
+    """Decorator recording how long every call takes, and whether it raised,
+    in the family's histogram for `label` (the function name by default).
+
+    If the call returns a generator, the time spent in the generator counts
+    too. It's recorded once the generator is exhausted or closed."""
+    def decorator(func):
+        name = label or func.__name__
+
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            start = now()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                registry.observe(family, name, now() - start, True)
+                raise
+            if isinstance(result, types.GeneratorType):
+                return _timed_generator(
+                    result, now() - start, family, name, registry
+                )
+            registry.observe(family, name, now() - start)
+            return result
+        return wrapped
+    return decorator
+
+
+def _timed_generator(generator, elapsed, family, label, registry):
+    """Yields what `generator` yields, adding up the time spent getting
+    each item. The time the caller spends in between doesn't count."""
+    error = False
+    try:
+        while True:
+            start = now()
+            try:
+                item = next(generator)
+            except StopIteration:
+                break
+            except Exception:
+                error = True
+                raise
+            finally:
+                elapsed += now() - start
+            yield item
+    finally:
+        generator.close()
+        registry.observe(family, label, elapsed, error)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+A pure Python FiSH engine. It produces the same output as encrypt_string and
+decrypt_string in fish/blowfish.c, but runs the cipher over every 8 byte block
+of every message at once with NumPy, so it needs no compiled library and gets
+faster the more text it is handed in one go.
+"""
+import numpy as np
+
+import blowfish_tables
+
+B64 = './0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+ROUNDS = 16
+WORD_MASK = 0xffffffff
+
+# 6 bit value -> char and char -> 6 bit value. Anything that isn't in B64
+# decodes to 0, like base64dec in blowfish.c
+B64_ENCODE = np.frombuffer(B64, dtype=np.uint8)
+B64_DECODE = np.zeros(256, dtype=np.uint64)
+B64_DECODE[B64_ENCODE] = np.arange(64, dtype=np.uint64)
+
+# Each word is written as 6 chars of 6 bits, least significant first
+SIX_BIT_SHIFTS = np.arange(0, 36, 6, dtype=np.uint64)
+
+
+def _encipher_word(xl, xr, p_array, s_boxes):
+    """Scalar blowfish_encipher, only used while building the key schedule"""
+    s0, s1, s2, s3 = s_boxes
+    xl ^= p_array[0]
+    for i in range(1, ROUNDS + 1):
+        f = (((s0[xl >> 24] + s1[(xl >> 16) & 0xff]) & WORD_MASK) ^
+             s2[(xl >> 8) & 0xff])
+        xr ^= ((f + s3[xl & 0xff]) & WORD_MASK) ^ p_array[i]
+        xl, xr = xr, xl
+    return xr ^ p_array[ROUNDS + 1], xl
+
+
+def _truncate_at_nul(text):
+    """The C code treats its input as a C string"""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    nul = text.find('\x00')
+    return text if nul == -1 else text[:nul]
+
+
+class NumpyFishEngine(object):
+    def __init__(self, key):
+        if not key:
+            raise ValueError('A non-empty fish key is required')
+
+        # blowfish_init uses at most 72 bytes of the key
+        key = bytearray(_truncate_at_nul(key)[:(ROUNDS + 2) * 4])
+        p_array = list(blowfish_tables.INIT_P)
+        s_boxes = [list(s_box) for s_box in blowfish_tables.INIT_S]
+
+        j = 0
+        for i in range(ROUNDS + 2):
+            p_array[i] ^= (
+                key[j] << 24 |
+                key[(j + 1) % len(key)] << 16 |
+                key[(j + 2) % len(key)] << 8 |
+                key[(j + 3) % len(key)]
+            )
+            j = (j + 4) % len(key)
+
+        datal, datar = 0, 0
+        for i in range(0, ROUNDS + 2, 2):
+            datal, datar = _encipher_word(datal, datar, p_array, s_boxes)
+            p_array[i], p_array[i + 1] = datal, datar
+
+        for s_box in s_boxes:
+            for i in range(0, 256, 2):
+                datal, datar = _encipher_word(datal, datar, p_array, s_boxes)
+                s_box[i], s_box[i + 1] = datal, datar
+
+        self.p_array = np.array(p_array, dtype=np.uint32)
+        self.s_boxes = np.array(s_boxes, dtype=np.uint32)
+
+    def _rounds(self, xl, xr, p_order):
+        """Runs the Feistel rounds over whole arrays of blocks at once.
+        `p_order` is the order the P-array is walked in, it is reversed for
+        deciphering."""
+        s0, s1, s2, s3 = self.s_boxes
+        p_array = self.p_array
+        xl = xl ^ p_array[p_order[0]]
+        for i in p_order[1:ROUNDS + 1]:
+            f = ((s0[xl >> 24] + s1[(xl >> 16) & 0xff]) ^
+                 s2[(xl >> 8) & 0xff]) + s3[xl & 0xff]
+            xr = xr ^ f ^ p_array[i]
+            xl, xr = xr, xl
+        return xr ^ p_array[p_order[ROUNDS + 1]], xl
+
+    def encipher(self, xl, xr):
+        """Enciphers arrays of left/right words"""
+        return self._rounds(xl, xr, range(ROUNDS + 2))
+
+    def decipher(self, xl, xr):
+        """Deciphers arrays of left/right words"""
+        return self._rounds(xl, xr, range(ROUNDS + 1, -1, -1))
+
+    def encrypt_many(self, plaintexts):
+        """Encrypts a list of strings, returns the FiSH base64 of each one
+        without the '+OK ' prefix"""
+        plaintexts = [_truncate_at_nul(text) for text in plaintexts]
+        block_counts = [(len(text) + 7) // 8 for text in plaintexts]
+        packed = ''.join(
+            text.ljust(count * 8, '\x00')
+            for text, count in zip(plaintexts, block_counts)
+        )
+        if not packed:
+            return ['' for _ in plaintexts]
+
+        words = np.frombuffer(packed, dtype='>u4').astype(np.uint32)
+        left, right = self.encipher(words[0::2], words[1::2])
+
+        sextets = np.empty((len(left), 12), dtype=np.uint64)
+        sextets[:, :6] = right.astype(np.uint64)[:, None] >> SIX_BIT_SHIFTS
+        sextets[:, 6:] = left.astype(np.uint64)[:, None] >> SIX_BIT_SHIFTS
+        encoded = B64_ENCODE[sextets & 0x3f].tobytes()
+
+        results, offset = [], 0
+        for count in block_counts:
+            results.append(encoded[offset:offset + count * 12])
+            offset += count * 12
+        return results
+
+    def decrypt_many(self, cipher_texts):
+        """Decrypts a list of FiSH base64 strings, with the trailing NUL
+        padding stripped off"""
+        cipher_texts = [_truncate_at_nul(text) for text in cipher_texts]
+        block_counts = [(len(text) + 11) // 12 for text in cipher_texts]
+        packed = ''.join(
+            text.ljust(count * 12, '\x00')
+            for text, count in zip(cipher_texts, block_counts)
+        )
+        if not packed:
+            return ['' for _ in cipher_texts]
+
+        sextets = B64_DECODE[np.frombuffer(packed, dtype=np.uint8)]
+        sextets = (sextets.reshape(-1, 2, 6) << SIX_BIT_SHIFTS).sum(axis=2)
+        # base64dec values shifted past 32 bits are lost in the C code too
+        sextets = (sextets & WORD_MASK).astype(np.uint32)
+        left, right = self.decipher(sextets[:, 1], sextets[:, 0])
+
+        words = np.empty(len(left) * 2, dtype='>u4')
+        words[0::2] = left
+        words[1::2] = right
+        decoded = words.tobytes()
+
+        results, offset = [], 0
+        for count in block_counts:
+            results.append(
+                decoded[offset:offset + count * 8].rstrip('\x00')
+            )
+            offset += count * 8
+        return results
+
+    def encrypt(self, plaintext):
+        return self.encrypt_many([plaintext])[0]
+
+    def decrypt(self, cipher_text):
+        return self.decrypt_many([cipher_text])[0]
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Everything the bot says goes through an OutboundQueue. Lines are queued per
+channel, consecutive short lines are packed into one PRIVMSG, and PRIVMSGs are
+paced with a token bucket so big replies don't get the bot throttled or
+killed for flooding.
+"""
+import collections
+
+import yolofish
+
+
+class Encrypted(str):
+    """A message that is already encrypted, it is sent as is"""
+
+
+class TokenBucket(object):
+    """Allows bursts of up to `burst` sends, refilled at `rate` sends per
+    second"""
+    def __init__(self, rate, burst, clock):
+        """
+        :param rate: How many sends per second are allowed in the long run
+        :param burst: How many sends can go out back to back
+        :param clock: Returns the current time in seconds
+        """
+        if rate <= 0:
+            raise ValueError('The flood rate must be positive')
+
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self.updated = clock()
+
+    def consume(self):
+        """Takes a token if there is one.
+
+        :return: 0 if a token was taken, otherwise how many seconds to wait
+        before trying again
+        """
+        now = self.clock()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class OutboundQueue(object):
+    """Encrypts and sends queued lines as fast as the token bucket allows.
+
+    Channels take turns, one PRIVMSG each, so a long reply in one channel
+    doesn't hold up the others.
+    """
+    def __init__(self, send, keyring, loop, rate=0.5, burst=5,
+                 max_length=None, separator=' | ',
+                 relay_prefix_length=yolofish.RELAY_PREFIX_LENGTH):
+        """
+        :param send: Called with (target, message) for every PRIVMSG, i.e.
+        bot.privmsg
+        :param keyring: The FishKeyring used to encrypt the lines
+        :param loop: The event loop the sends are scheduled on
+        :param rate: How many PRIVMSGs per second are sent in the long run
+        :param burst: How many PRIVMSGs can be sent back to back
+        :param max_length: How long an encrypted message can get, by default
+        as long as fits in the IRC line to the target
+        :param separator: Goes between lines that were packed together
+        :param relay_prefix_length: How much of the IRC line to leave for the
+        nick!user@host the server puts in front of relayed messages
+        """
+        self.send = send
+        self.keyring = keyring
+        self.loop = loop
+        self.bucket = TokenBucket(rate, burst, loop.time)
+        self.separator = separator
+        self.max_length = max_length
+        self.relay_prefix_length = relay_prefix_length
+        # target -> how many bytes of plaintext a message to it can carry
+        self._budgets = {}
+
+        # target -> lines waiting to be sent, in the order targets take turns
+        self.queues = collections.OrderedDict()
+        self._handle = None
+        self.stats = {
+            'queued': 0,
+            'sent': 0,
+            'packed': 0,
+            'delayed': 0,
+            'dropped': 0,
+            'max_depth': 0,
+        }
+
+    def line_budget(self, target):
+        """How many bytes of plaintext fit in one message to `target`"""
+        budget = self._budgets.get(target)
+        if budget is None:
+            max_length = yolofish.message_budget(
+                target, self.relay_prefix_length
+            )
+            if self.max_length is not None:
+                max_length = min(max_length, self.max_length)
+            budget = self._budgets[target] = yolofish.plaintext_budget(
+                max_length
+            )
+        return budget
+
+    def depth(self, target=None):
+        """How many lines are waiting to be sent, to `target` or in total"""
+        if target is not None:
+            return len(self.queues.get(target, ()))
+        return sum(len(lines) for lines in self.queues.itervalues())
+
+    def _enqueue(self, target, items):
+        if self.keyring.get(target) is None:
+            # plain text is never sent
+            self.stats['dropped'] += len(items)
+            return
+
+        queue = self.queues.get(target)
+        if queue is None:
+            queue = self.queues[target] = collections.deque()
+        queue.extend(items)
+        self.stats['queued'] += len(items)
+
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.depth())
+        if self._handle is None:
+            self._handle = self.loop.call_soon(self._drain)
+
+    @staticmethod
+    def _split(lines, budget):
+        pieces = []
+        for line in lines:
+            pieces.extend(yolofish.YoloFish.split(line, budget))
+        return pieces
+
+    def put(self, target, lines):
+        """Queues lines to be sent to `target`. Lines for targets without a
+        fish key are dropped."""
+        self._enqueue(target, self._split(lines, self.line_budget(target)))
+
+    def put_encrypted(self, target, messages):
+        """Queues messages that were already encrypted for `target`, e.g.
+        with the lines returned by `pack`"""
+        self._enqueue(target, [Encrypted(message) for message in messages])
+
+    def _pack(self, queue, budget):
+        """Pops the next line off `queue`, with as many of the plaintext lines
+        after it appended as fit in `budget` bytes"""
+        line = queue.popleft()
+        if isinstance(line, Encrypted):
+            return line
+
+        while queue and not isinstance(queue[0], Encrypted):
+            packed = line + self.separator + queue[0]
+            if len(packed) > budget:
+                break
+            line = packed
+            queue.popleft()
+            self.stats['packed'] += 1
+        return line
+
+    def pack(self, target, lines):
+        """Splits and packs lines the same way lines queued for `target` are,
+        so the result can be encrypted ahead of time and sent with
+        `put_encrypted`"""
+        budget = self.line_budget(target)
+        queue = collections.deque(self._split(lines, budget))
+        packed = []
+        while queue:
+            packed.append(self._pack(queue, budget))
+        return packed
+
+    def _drain(self):
+        self._handle = None
+        while self.queues:
+            wait = self.bucket.consume()
+            if wait:
+                self.stats['delayed'] += 1
+                self._handle = self.loop.call_later(wait, self._drain)
+                return
+
+            target, queue = self.queues.popitem(last=False)
+            line = self._pack(queue, self.line_budget(target))
+            if queue:
+                # back of the line for the next turn
+                self.queues[target] = queue
+
+            if isinstance(line, Encrypted):
+                messages = [line]
+            else:
+                fish = self.keyring.get(target)
+                if fish is None:
+                    self.stats['dropped'] += 1
+                    continue
+                # lines taken over from a queue with a bigger budget can
+                # still be too long
+                messages = fish.encrypt_many([line], self.line_budget(target))
+            for message in messages:
+                self.send(target, str(message))
+                self.stats['sent'] += 1
+
+    def take_over(self, old):
+        """Moves the queued lines of another queue, e.g. one built by the
+        code before a reload, over to this one. The flood limits carry on
+        from where the old queue left them."""
+        if old._handle is not None:
+            old._handle.cancel()
+            old._handle = None
+        self.bucket.tokens = min(old.bucket.tokens, self.bucket.burst)
+        self.bucket.updated = old.bucket.updated
+        for key, value in old.stats.items():
+            if key in self.stats:
+                self.stats[key] += value
+
+        for target, queue in old.queues.items():
+            # ciphertext queued by an older version of this module is an
+            # instance of that version's Encrypted
+            self._enqueue(target, [
+                line if type(line) in (str, unicode) else Encrypted(line)
+                for line in queue
+            ])
+        old.queues.clear()
+
+    def close(self):
+        """Stops sending, whatever is still queued is dropped"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self.stats['dropped'] += self.depth()
+        self.queues.clear()
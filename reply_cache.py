@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Keeps the encrypted lines of recent !site replies, so asking for a popular
+site again skips formatting and encryption.
+"""
+import collections
+import hashlib
+import json
+
+
+def site_revision(site):
+    """A digest of the whole site document, it changes whenever any of its
+    fields does"""
+    return hashlib.sha1(json.dumps(site, sort_keys=True)).hexdigest()
+
+
+class ReplyCache(object):
+    """An LRU of encrypted replies keyed by (site name, revision, fish key).
+
+    Only the latest revision of a site is kept per key, and writes to a site
+    drop all of its entries with `invalidate`.
+    """
+    def __init__(self, max_size=256):
+        """
+        :param max_size: How many replies to keep, 0 disables the cache
+        """
+        self.max_size = max(0, max_size)
+        self._entries = collections.OrderedDict()
+        # site name -> keys of its entries in _entries
+        self._site_entries = collections.defaultdict(set)
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+            'evictions': 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _forget(self, entry_key):
+        self._entries.pop(entry_key, None)
+        entries = self._site_entries.get(entry_key[0])
+        if entries is not None:
+            entries.discard(entry_key)
+            if not entries:
+                del self._site_entries[entry_key[0]]
+
+    def get(self, site_name, revision, key):
+        """Returns the cached messages, or None"""
+        entry_key = (site_name, revision, key)
+        messages = self._entries.pop(entry_key, None)
+        if messages is None:
+            self.stats['misses'] += 1
+            return None
+
+        self._entries[entry_key] = messages
+        self.stats['hits'] += 1
+        return messages
+
+    def put(self, site_name, revision, key, messages):
+        if not self.max_size:
+            return
+
+        # older revisions encrypted with the same key are dead weight
+        for entry_key in list(self._site_entries.get(site_name, ())):
+            if entry_key[2] == key:
+                self._forget(entry_key)
+
+        entry_key = (site_name, revision, key)
+        self._entries[entry_key] = tuple(messages)
+        self._site_entries[site_name].add(entry_key)
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._forget(oldest)
+            self.stats['evictions'] += 1
+
+    def invalidate(self, site_name):
+        """Drops every reply cached for the site"""
+        for entry_key in list(self._site_entries.get(site_name, ())):
+            self._forget(entry_key)
+            self.stats['invalidations'] += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._site_entries.clear()
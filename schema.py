@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Compiles the fields in sitebot_config once, into what commands look up on
+every call: frozensets of field names, a caster per field that turns the
+words of a command into the stored value, and a Site class with a slot per
+field.
+
+Site records keep list values as tuples, of interned strings if they're
+given an intern table, so values shared by many sites (affils, users) are
+stored once. A cache of thousands of sites takes a fraction of the memory the
+same sites take as dicts.
+"""
+import sitebot_config
+
+# what InvalidType errors call each type
+TYPE_NAMES = {str: 'string', int: 'integer', float: 'float', list: 'list'}
+
+# the value of the slots of fields a site doesn't have
+_MISSING = object()
+
+
+class Site(object):
+    """Base of the Site classes Schema builds. Reads like the site document
+    it was made from, missing fields are simply not there."""
+    __slots__ = ()
+    schema = None
+
+    @classmethod
+    def from_dict(cls, document, interned=None):
+        """
+        :param document: The site document
+        :param interned: Maps list values to the one copy of them that all
+        records made with the same dict share, new values are added to it
+        """
+        site = cls()
+        schema = cls.schema
+        for field in schema.sorted_fields:
+            value = document.get(field, _MISSING)
+            if field in schema.list_fields and isinstance(value, list):
+                if interned is not None:
+                    value = [interned.setdefault(v, v) for v in value]
+                value = tuple(value)
+            setattr(site, field, value)
+
+        # keep whatever isn't in the schema, e.g. fields that were removed
+        # from sitebot_config
+        site._extra = None
+        if not schema.fields.issuperset(document):
+            site._extra = {
+                field: value for field, value in document.iteritems()
+                if field not in schema.fields
+            }
+        return site
+
+    def to_dict(self):
+        """A new site document, changing it doesn't change the record. Each
+        Site class gets its own, see Schema._compile_to_dict."""
+        raise NotImplementedError()
+
+    def get(self, field, default=None):
+        if field in self.schema.fields:
+            value = getattr(self, field)
+            return default if value is _MISSING else value
+        if self._extra:
+            return self._extra.get(field, default)
+        return default
+
+    def __getitem__(self, field):
+        value = self.get(field, _MISSING)
+        if value is _MISSING:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field):
+        return self.get(field, _MISSING) is not _MISSING
+
+    def __eq__(self, other):
+        if isinstance(other, Site):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.to_dict())
+
+
+class Schema(object):
+    def __init__(self, fields, always_uppercase, primary_key='name'):
+        """
+        :param fields: FIELDS from sitebot_config
+        :param always_uppercase: ALWAYS_UPPERCASE from sitebot_config
+        :param primary_key: The field sites are keyed by
+        """
+        self.types = {
+            field['column_name']: field['type'] for field in fields.values()
+        }
+        self.primary_key = primary_key
+        self.fields = frozenset(self.types)
+        self.sorted_fields = tuple(sorted(self.fields))
+        self.list_fields = frozenset(
+            field for field, field_type in self.types.items()
+            if field_type == list
+        )
+        self.uppercase = frozenset(always_uppercase)
+        self.casters = {
+            field: self._caster(field, field_type)
+            for field, field_type in self.types.items()
+        }
+        self.Site = type('Site', (Site,), {
+            '__slots__': self.sorted_fields + ('_extra',),
+            'schema': self,
+            'to_dict': self._compile_to_dict(),
+        })
+
+    def _compile_to_dict(self):
+        """Generates Site.to_dict with one statement per field, it runs on
+        every read from the site cache"""
+        lines = [
+            'def to_dict(self):',
+            '    document = dict(self._extra) if self._extra else {}',
+        ]
+        for field in self.sorted_fields:
+            lines.append('    value = self.{}'.format(field))
+            if field in self.list_fields:
+                lines.append(
+                    '    if value.__class__ is tuple: value = list(value)'
+                )
+            lines.append(
+                '    if value is not MISSING: document[{!r}] = value'.format(
+                    field
+                )
+            )
+        lines.append('    return document')
+
+        namespace = {'MISSING': _MISSING}
+        exec '\n'.join(lines) in namespace
+        return namespace['to_dict']
+
+    def _caster(self, field, field_type):
+        """Builds the function turning the words of a command into the value
+        stored in `field`. It raises ValueError if they don't make one."""
+        upper = field in self.uppercase
+        if field_type == list:
+            if upper:
+                return lambda words: [word.upper() for word in words]
+            return lambda words: list(words)
+        if field_type == str:
+            if upper:
+                return lambda words: ' '.join(words).upper()
+            return lambda words: ' '.join(words)
+        return lambda words: field_type(' '.join(words))
+
+
+SCHEMA = Schema(sitebot_config.FIELDS, sitebot_config.ALWAYS_UPPERCASE)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import rethinkdb as r
+
+import schema
+import site_index
+
+
+class SiteCache(object):
+    """A complete in-memory copy of the sites table, kept as schema.Site
+    records. Reads hand out new dicts, so callers can't change the cached
+    sites.
+
+    A background thread subscribes to the table's changefeed, loads the whole
+    table and then applies every change as it arrives. If the feed drops, the
+    cache stops answering (`ready` goes False) until the thread has
+    resubscribed and done a full reload.
+    """
+    def __init__(self, yolodb, retry_delay=5):
+        """
+        :param yolodb: The YoloDB whose sites table is mirrored
+        :param retry_delay: Seconds to wait before resubscribing after the
+        feed dropped
+        """
+        self.db = yolodb
+        self.retry_delay = retry_delay
+        self.sites = {}
+        self.index = site_index.SiteIndex()
+        self.ready = False
+
+        self._lock = threading.RLock()
+        self._sorted_names = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._feed_conn = None
+
+        # when the cache was last known to match the table
+        self.synced_at = None
+        self.stats = {
+            'reloads': 0,
+            'changes': 0,
+            'feed_errors': 0,
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._follow_feed)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.ready = False
+        conn = self._feed_conn
+        if conn is not None:
+            # wakes the feed thread up if it is waiting for a change
+            try:
+                conn.close(noreply_wait=False)
+            except r.errors.RqlDriverError:
+                pass
+
+    def staleness(self):
+        """Seconds the cache may be behind the table: 0 while the feed is
+        up, otherwise the time since it was last in sync"""
+        if self.ready:
+            return 0.0
+        if self.synced_at is None:
+            return float('inf')
+        return time.time() - self.synced_at
+
+    def _follow_feed(self):
+        while not self._stop.is_set():
+            try:
+                self._feed_conn = r.connect(self.db.host, db=self.db.db_name)
+                table = r.table(self.db.SITES_TABLE_NAME)
+                # subscribe before loading so no change falls in between
+                feed = table.changes().run(self._feed_conn)
+                self.reload(table.run(self._feed_conn))
+                for change in feed:
+                    self.apply(change.get('old_val'), change.get('new_val'))
+            except Exception:
+                # the feed dropped, resubscribe and reload from scratch
+                with self._lock:
+                    self.stats['feed_errors'] += 1
+            finally:
+                self.ready = False
+                if self._feed_conn is not None:
+                    try:
+                        self._feed_conn.close(noreply_wait=False)
+                    except r.errors.RqlDriverError:
+                        pass
+                    self._feed_conn = None
+
+            self._stop.wait(self.retry_delay)
+
+    def reload(self, sites):
+        """Replaces the whole cache with the given site documents. Their
+        list values are interned in a table that is dropped once the records
+        are built, so values no site has any more don't stay around."""
+        Site, interned = schema.SCHEMA.Site, {}
+        sites = {
+            site['name']: Site.from_dict(site, interned) for site in sites
+        }
+        index = site_index.SiteIndex()
+        index.rebuild(sites.itervalues())
+        with self._lock:
+            self.sites = sites
+            self.index = index
+            self._sorted_names = None
+            self.synced_at = time.time()
+            self.ready = True
+            self.stats['reloads'] += 1
+
+    def apply(self, old_val, new_val):
+        """Applies one change, as found in changefeeds and write responses"""
+        if new_val is None and old_val is None:
+            return
+
+        name = (new_val or old_val)['name']
+        with self._lock:
+            # the cached document is what the index was built from
+            self.index.update(self.sites.get(name), new_val)
+            if new_val is None:
+                if self.sites.pop(name, None) is not None:
+                    self._sorted_names = None
+            else:
+                if name not in self.sites:
+                    self._sorted_names = None
+                # not interned, the values of a single change are few
+                self.sites[name] = schema.SCHEMA.Site.from_dict(new_val)
+            if self.ready:
+                self.synced_at = time.time()
+            self.stats['changes'] += 1
+
+    def apply_response(self, response):
+        """Applies the 'changes' of a write response run with
+        return_changes=True"""
+        for change in response.get('changes', []):
+            # return_changes='always' also returns documents it didn't change
+            if change.get('old_val') != change.get('new_val'):
+                self.apply(change.get('old_val'), change.get('new_val'))
+
+    def sorted_names(self):
+        with self._lock:
+            if self._sorted_names is None:
+                self._sorted_names = sorted(self.sites)
+            return self._sorted_names
+
+    def documents(self):
+        """Every cached site document"""
+        with self._lock:
+            return [site.to_dict() for site in self.sites.itervalues()]
+
+    def get_site(self, site_name):
+        site = self.sites.get(site_name)
+        return site.to_dict() if site is not None else None
+
+    def list_sites(self):
+        return [{'name': name} for name in self.sorted_names()]
+
+    def search(self, field, value, field_type):
+        """Same results as YoloDB.search, without a query. List fields (and
+        site_index.ALL_FIELDS) go through the index and can use wildcards."""
+        if field_type == list:
+            with self._lock:
+                return [
+                    self.sites[name].to_dict()
+                    for name in sorted(self.index.search(field, value))
+                ]
+
+        with self._lock:
+            names, sites = self.sorted_names(), self.sites
+
+        results = []
+        for name in names:
+            site = sites.get(name)
+            if site is None or field not in site:
+                continue
+            if site[field] == value:
+                results.append(site.to_dict())
+        return results
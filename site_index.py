@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+An inverted index over the list fields of every site, with a prefix trie per
+field, so wildcard searches like `!search affils GRP*` are answered without
+touching the database.
+"""
+import re
+
+import sitebot_config
+import yolo_utils
+
+# Searching this field searches every list field at once
+ALL_FIELDS = 'all'
+LIST_FIELDS = tuple(sorted(
+    field for field, field_type in sitebot_config.COLUMN_MAPPING.items()
+    if field_type == list
+))
+WILDCARD = '*'
+
+
+def is_pattern(value):
+    return WILDCARD in value
+
+
+def pattern_to_regex(pattern):
+    """Turns a pattern where * matches anything into an anchored regex"""
+    return '^{}$'.format('.*'.join(
+        re.escape(part) for part in pattern.split(WILDCARD)
+    ))
+
+
+class _Node(object):
+    __slots__ = ('children', 'sites')
+
+    def __init__(self):
+        self.children = {}
+        # names of the sites having the value that ends at this node
+        self.sites = None
+
+
+class PrefixTrie(object):
+    """Maps values to the names of the sites that have them"""
+    def __init__(self):
+        self.root = _Node()
+
+    def add(self, value, site_name):
+        node = self.root
+        for char in value:
+            node = node.children.setdefault(char, _Node())
+        if node.sites is None:
+            node.sites = set()
+        node.sites.add(site_name)
+
+    def remove(self, value, site_name):
+        path, node = [], self.root
+        for char in value:
+            path.append((node, char))
+            node = node.children.get(char)
+            if node is None:
+                return
+
+        if node.sites is not None:
+            node.sites.discard(site_name)
+            if not node.sites:
+                node.sites = None
+
+        # prune the branch if nothing is left below it
+        for parent, char in reversed(path):
+            child = parent.children[char]
+            if child.sites is not None or child.children:
+                break
+            del parent.children[char]
+
+    def _find(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def get(self, value):
+        """Sites having exactly this value"""
+        node = self._find(value)
+        if node is None or node.sites is None:
+            return set()
+        return set(node.sites)
+
+    def items(self, prefix=''):
+        """Yields (value, site names) for every value starting with
+        `prefix`"""
+        node = self._find(prefix)
+        if node is None:
+            return
+
+        stack = [(prefix, node)]
+        while stack:
+            value, node = stack.pop()
+            if node.sites is not None:
+                yield value, node.sites
+            for char, child in node.children.iteritems():
+                stack.append((value + char, child))
+
+    def match(self, pattern):
+        """Sites having a value that matches the pattern. Only the values
+        under the pattern's literal prefix are looked at."""
+        if not is_pattern(pattern):
+            return self.get(pattern)
+
+        prefix = pattern.split(WILDCARD, 1)[0]
+        results = set()
+        if pattern == prefix + WILDCARD:
+            for _, sites in self.items(prefix):
+                results.update(sites)
+            return results
+
+        regex = re.compile(pattern_to_regex(pattern))
+        for value, sites in self.items(prefix):
+            if regex.match(value):
+                results.update(sites)
+        return results
+
+
+class SiteIndex(object):
+    """One PrefixTrie per list field, kept up to date one site at a time"""
+    def __init__(self, fields=LIST_FIELDS):
+        self.fields = fields
+        self.tries = {field: PrefixTrie() for field in fields}
+
+    def add_site(self, site):
+        for field in self.fields:
+            for value in site.get(field) or ():
+                self.tries[field].add(value, site['name'])
+
+    def remove_site(self, site):
+        for field in self.fields:
+            for value in site.get(field) or ():
+                self.tries[field].remove(value, site['name'])
+
+    def update(self, old_val, new_val):
+        """Applies a change in the same old_val/new_val form as changefeeds"""
+        if old_val is not None:
+            self.remove_site(old_val)
+        if new_val is not None:
+            self.add_site(new_val)
+
+    def rebuild(self, sites):
+        self.tries = {field: PrefixTrie() for field in self.fields}
+        for site in sites:
+            self.add_site(site)
+
+    def search(self, field, pattern):
+        """Names of the sites where `field` has a value matching `pattern`.
+        With ALL_FIELDS every list field is searched, and the pattern is
+        uppercased for the fields in ALWAYS_UPPERCASE."""
+        if field != ALL_FIELDS:
+            return self.tries[field].match(pattern)
+
+        results = set()
+        for field in self.fields:
+            results.update(self.tries[field].match(
+                yolo_utils.uppercase_if_needed(field, pattern)
+            ))
+        return results
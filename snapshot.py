@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+A compact binary copy of the sites table and its search index. It is read
+through mmap, so a restarted bot can answer !site, !sites and !search before
+it has heard back from the database.
+
+After a small header the file is a run of string tables. A string table is a
+count, count + 1 offsets and the strings back to back, so any string can be
+read without touching the others. The tables are the list fields the index
+covers, the sorted site names, the JSON documents in the same order, and for
+every list field its sorted values followed by, per value, the ids (positions
+in the name table) of the sites having it. Nothing is decoded when the file
+is opened, lookups are binary searches over the mapped bytes.
+"""
+import bisect
+import json
+import mmap
+import os
+import re
+import struct
+import time
+
+import site_index
+import yolo_utils
+
+MAGIC = 'YOLOSNAP'
+VERSION = 1
+# magic, version, when the snapshot was written
+HEADER = struct.Struct('<8sId')
+COUNT = struct.Struct('<I')
+BOUNDS = struct.Struct('<II')
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _pack_table(strings):
+    offsets, total = [0], 0
+    for string in strings:
+        total += len(string)
+        offsets.append(total)
+    return ''.join([
+        COUNT.pack(len(strings)),
+        struct.pack('<{}I'.format(len(offsets)), *offsets),
+    ] + strings)
+
+
+def _pack_ids(ids):
+    return struct.pack('<{}I'.format(len(ids)), *ids)
+
+
+def _unpack_ids(packed):
+    return struct.unpack('<{}I'.format(len(packed) // COUNT.size), packed)
+
+
+class _StringTable(object):
+    """A string table inside the mapped file. It's a sequence, so bisect
+    works on it directly."""
+    def __init__(self, buf, offset):
+        self.buf = buf
+        self.count = COUNT.unpack_from(buf, offset)[0]
+        self.offsets = offset + COUNT.size
+        self.data = self.offsets + COUNT.size * (self.count + 1)
+        if self.data > len(buf):
+            raise ValueError('string table past the end of the file')
+        size = COUNT.unpack_from(buf, self.data - COUNT.size)[0]
+        self.end = self.data + size
+        if self.end > len(buf):
+            raise ValueError('string table past the end of the file')
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        start, end = BOUNDS.unpack_from(self.buf, self.offsets + 4 * i)
+        return self.buf[self.data + start:self.data + end]
+
+
+def write(path, sites):
+    """Writes a snapshot of the given site documents. The file is replaced
+    in one go, so a bot starting up never maps a half written one."""
+    sites = sorted(sites, key=lambda site: _encode(site['name']))
+    postings = {field: {} for field in site_index.LIST_FIELDS}
+    for site_id, site in enumerate(sites):
+        for field in site_index.LIST_FIELDS:
+            for value in set(site.get(field) or ()):
+                postings[field].setdefault(_encode(value), []).append(site_id)
+
+    parts = [
+        HEADER.pack(MAGIC, VERSION, time.time()),
+        _pack_table(list(site_index.LIST_FIELDS)),
+        _pack_table([_encode(site['name']) for site in sites]),
+        _pack_table([
+            json.dumps(site, sort_keys=True, separators=(',', ':'))
+            for site in sites
+        ]),
+    ]
+    for field in site_index.LIST_FIELDS:
+        values = sorted(postings[field])
+        parts.append(_pack_table(values))
+        parts.append(_pack_table([
+            _pack_ids(postings[field][value]) for value in values
+        ]))
+
+    temp_path = '{}.tmp'.format(path)
+    with open(temp_path, 'wb') as snapshot_file:
+        snapshot_file.write(''.join(parts))
+    os.rename(temp_path, path)
+    return len(sites)
+
+
+class Snapshot(object):
+    """A snapshot file mapped into memory, answering the same reads as
+    site_cache.SiteCache"""
+
+    class InvalidSnapshot(Exception):
+        """Raised when the file isn't a snapshot this version can read"""
+        pass
+
+    def __init__(self, path):
+        """
+        :param path: The snapshot file, IOError is raised if it can't be
+        opened
+        """
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            try:
+                self._map = mmap.mmap(
+                    snapshot_file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+            except (ValueError, mmap.error):
+                # mmap refuses empty files
+                raise self.InvalidSnapshot('{} is empty'.format(path))
+
+        try:
+            self._parse()
+        except (ValueError, struct.error) as e:
+            self.close()
+            raise self.InvalidSnapshot('{}: {}'.format(path, e))
+
+    def _parse(self):
+        magic, version, self.written_at = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a version {} snapshot'.format(VERSION))
+
+        fields = _StringTable(self._map, HEADER.size)
+        if tuple(fields) != site_index.LIST_FIELDS:
+            raise ValueError('written for other list fields')
+
+        self.names = _StringTable(self._map, fields.end)
+        self.docs = _StringTable(self._map, self.names.end)
+        if len(self.docs) != len(self.names):
+            raise ValueError('names and documents differ in number')
+
+        # field -> (sorted values, ids of the sites having each value)
+        self.index = {}
+        end = self.docs.end
+        for field in site_index.LIST_FIELDS:
+            values = _StringTable(self._map, end)
+            postings = _StringTable(self._map, values.end)
+            self.index[field] = (values, postings)
+            end = postings.end
+        if end != len(self._map):
+            raise ValueError('trailing bytes')
+
+    def __len__(self):
+        return len(self.names)
+
+    def close(self):
+        self._map.close()
+
+    def age(self):
+        """Seconds since the snapshot was written"""
+        return time.time() - self.written_at
+
+    def _load(self, site_id):
+        return json.loads(self.docs[site_id])
+
+    def get_site(self, site_name):
+        name = _encode(site_name)
+        site_id = bisect.bisect_left(self.names, name)
+        if site_id < len(self.names) and self.names[site_id] == name:
+            return self._load(site_id)
+        return None
+
+    def sorted_names(self):
+        return [name.decode('utf-8') for name in self.names]
+
+    def list_sites(self):
+        return [{'name': name} for name in self.sorted_names()]
+
+    def _match(self, field, pattern):
+        """Ids of the sites where `field` has a value matching `pattern`.
+        Only the values under the pattern's literal prefix are looked at."""
+        values, postings = self.index[field]
+        pattern = _encode(pattern)
+        if not site_index.is_pattern(pattern):
+            i = bisect.bisect_left(values, pattern)
+            if i < len(values) and values[i] == pattern:
+                return set(_unpack_ids(postings[i]))
+            return set()
+
+        prefix = pattern.split(site_index.WILDCARD, 1)[0]
+        regex = None
+        if pattern != prefix + site_index.WILDCARD:
+            regex = re.compile(site_index.pattern_to_regex(pattern))
+
+        site_ids = set()
+        for i in xrange(bisect.bisect_left(values, prefix), len(values)):
+            value = values[i]
+            if not value.startswith(prefix):
+                break
+            if regex is None or regex.match(value):
+                site_ids.update(_unpack_ids(postings[i]))
+        return site_ids
+
+    def search(self, field, value, field_type):
+        """Same results as site_cache.SiteCache.search"""
+        if field_type == list:
+            if field != site_index.ALL_FIELDS:
+                site_ids = self._match(field, value)
+            else:
+                site_ids = set()
+                for list_field in site_index.LIST_FIELDS:
+                    site_ids.update(self._match(
+                        list_field,
+                        yolo_utils.uppercase_if_needed(list_field, value)
+                    ))
+            # ids follow the name order
+            return [self._load(site_id) for site_id in sorted(site_ids)]
+
+        results = []
+        for site_id in xrange(len(self.docs)):
+            site = self._load(site_id)
+            if field in site and site[field] == value:
+                results.append(site)
+        return results
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""
+An embedded SQLite backend, for bots that don't want to run a RethinkDB
+server.
+
+Scalar fields are columns of the sites table. Every list field gets its own
+table of (site, value) rows with an index on the value, so searching a list
+field is an index lookup, and * patterns turn into GLOBs that can use the
+index up to their first wildcard. The database runs in WAL mode, so reads
+don't wait for writes, and every thread gets its own connection.
+"""
+import contextlib
+import sqlite3
+import threading
+
+import metrics
+import site_index
+import sitebot_config
+import storage
+import yolo_utils
+from storage import uppercase_site_name
+
+SQL_TYPES = {str: 'TEXT', int: 'INTEGER', float: 'REAL'}
+
+SCALAR_FIELDS = tuple(sorted(
+    field for field, field_type in sitebot_config.COLUMN_MAPPING.items()
+    if field_type != list and field != storage.SiteStore.PRIMARY_KEY
+))
+LIST_FIELDS = site_index.LIST_FIELDS
+
+# how many rows to fetch per query while streaming results
+BATCH_SIZE = 500
+# stay under SQLITE_MAX_VARIABLE_NUMBER of older SQLite versions
+MAX_VARIABLES = 900
+
+
+def list_table(field):
+    return 'sites_{}'.format(field)
+
+
+def pattern_to_glob(pattern):
+    """Turns a pattern where * matches anything into a GLOB pattern. The
+    other GLOB wildcards are escaped."""
+    return pattern.replace('[', '[[]').replace('?', '[?]')
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class SqliteYoloDB(storage.SiteStore):
+    def __init__(self, path, timeout=30):
+        """
+        :param path: The database file, created if it doesn't exist
+        :param timeout: Seconds a write waits for another one to finish
+        """
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+        with self.transaction() as conn:
+            self.create_tables(conn)
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def connection(self):
+        """The connection of the calling thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs the with block in a write transaction on the calling thread's
+        connection"""
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def close(self):
+        """Closes the connections of every thread"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    def create_tables(self, conn):
+        columns = ''.join(
+            ', {} {}'.format(
+                field, SQL_TYPES[sitebot_config.COLUMN_MAPPING[field]]
+            )
+            for field in SCALAR_FIELDS
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS {} ({} TEXT PRIMARY KEY{})'.format(
+                self.SITES_TABLE_NAME, self.PRIMARY_KEY, columns
+            )
+        )
+        for field in SCALAR_FIELDS:
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})'.format(
+                    self.SITES_TABLE_NAME, field
+                )
+            )
+
+        for field in LIST_FIELDS:
+            # rows are kept in insertion order through the rowid
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS {} ('
+                'site TEXT NOT NULL REFERENCES {}({}) ON DELETE CASCADE, '
+                'value TEXT NOT NULL, '
+                'UNIQUE (site, value))'.format(
+                    list_table(field), self.SITES_TABLE_NAME, self.PRIMARY_KEY
+                )
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS {0}_value ON {0} (value, site)'
+                .format(list_table(field))
+            )
+
+    def _load(self, conn, names):
+        """Reads whole site documents.
+
+        :return: Maps the name of every site that exists to its document
+        """
+        sites = {}
+        for chunk in _chunks(list(names), MAX_VARIABLES):
+            placeholders = ', '.join('?' * len(chunk))
+            rows = conn.execute(
+                'SELECT {} FROM {} WHERE {} IN ({})'.format(
+                    ', '.join((self.PRIMARY_KEY,) + SCALAR_FIELDS),
+                    self.SITES_TABLE_NAME,
+                    self.PRIMARY_KEY,
+                    placeholders
+                ),
+                chunk
+            )
+            for row in rows:
+                site = {self.PRIMARY_KEY: row[0]}
+                for field, value in zip(SCALAR_FIELDS, row[1:]):
+                    if value is not None:
+                        site[field] = value
+                for field in LIST_FIELDS:
+                    site[field] = []
+                sites[row[0]] = site
+
+            for field in LIST_FIELDS:
+                rows = conn.execute(
+                    'SELECT site, value FROM {} WHERE site IN ({}) '
+                    'ORDER BY rowid'.format(list_table(field), placeholders),
+                    chunk
+                )
+                for name, value in rows:
+                    sites[name][field].append(value)
+        return sites
+
+    def _get(self, conn, site_name):
+        return self._load(conn, [site_name]).get(site_name)
+
+    def _write(self, conn, site_name, field, value):
+        """Replaces the value of a field inside a transaction"""
+        if sitebot_config.COLUMN_MAPPING[field] != list:
+            conn.execute(
+                'UPDATE {} SET {} = ? WHERE {} = ?'.format(
+                    self.SITES_TABLE_NAME, field, self.PRIMARY_KEY
+                ),
+                (value, site_name)
+            )
+            return
+
+        conn.execute(
+            'DELETE FROM {} WHERE site = ?'.format(list_table(field)),
+            (site_name,)
+        )
+        self._insert_values(conn, site_name, field, value)
+
+    @staticmethod
+    def _insert_values(conn, site_name, field, values):
+        conn.executemany(
+            'INSERT OR IGNORE INTO {} (site, value) VALUES (?, ?)'.format(
+                list_table(field)
+            ),
+            [(site_name, value) for value in values]
+        )
+
+    @staticmethod
+    def _delete_values(conn, site_name, field, values):
+        conn.executemany(
+            'DELETE FROM {} WHERE site = ? AND value = ?'.format(
+                list_table(field)
+            ),
+            [(site_name, value) for value in values]
+        )
+
+    def _update(self, site_name, update):
+        """Changes a single site in one transaction.
+
+        :param update: Called with the connection and the current document,
+        makes the changes
+        :return: The write response
+        """
+        with self.transaction() as conn:
+            old_val = self._get(conn, site_name)
+            if old_val is None:
+                return storage.write_response(skipped=1)
+            update(conn, old_val)
+            new_val = self._get(conn, site_name)
+
+        if new_val == old_val:
+            return storage.write_response(unchanged=1)
+        return storage.write_response(
+            replaced=1, changes=[{'old_val': old_val, 'new_val': new_val}]
+        )
+
+    @metrics.timed('db')
+    @uppercase_site_name
+    def add_site(self, site_name):
+        """Adds a site to the database"""
+        try:
+            with self.transaction() as conn:
+                conn.execute(
+                    'INSERT INTO {} ({}) VALUES (?)'.format(
+                        self.SITES_TABLE_NAME, self.PRIMARY_KEY
+                    ),
+                    (site_name,)
+                )
+        except sqlite3.IntegrityError:
+            raise self.AlreadyExistsError()
+
+    @metrics.timed('db')
+    @uppercase_site_name
+    def add_value(self, site_name, field, value):
+        value = self.validate_field(field, value)
+        if sitebot_config.COLUMN_MAPPING[field] != list:
+            raise self.InvalidType('list')
+
+        result = self._update(
+            site_name,
+            lambda conn, _: self._insert_values(conn, site_name, field, value)
+        )
+        if result['skipped']:
+            return None
+        if result['changes']:
+            return result['changes'][0]['new_val'][field]
+        return self.get_site(site_name)[field]
+
+    @metrics.timed('db')
+    @uppercase_site_name
+    def remove_value(self, site_name, field, value):
+        value = self.validate_field(field, value)
+
+        def remove(conn, site):
+            if sitebot_config.COLUMN_MAPPING[field] == list:
+                self._delete_values(conn, site_name, field, value)
+
+        return self._update(site_name, remove)
+
+    @metrics.timed('db')
+    @uppercase_site_name
+    def set_value(self, site_name, field, value):
+        value = self.validate_field(field, value)
+        return self._update(
+            site_name,
+            lambda conn, site: self._write(conn, site_name, field, value)
+        )
+
+    @metrics.timed('db')
+    @uppercase_site_name
+    def delete_site(self, site_name):
+        with self.transaction() as conn:
+            old_val = self._get(conn, site_name)
+            if old_val is None:
+                return storage.write_response(skipped=1)
+            conn.execute(
+                'DELETE FROM {} WHERE {} = ?'.format(
+                    self.SITES_TABLE_NAME, self.PRIMARY_KEY
+                ),
+                (site_name,)
+            )
+        return storage.write_response(
+            deleted=1, changes=[{'old_val': old_val, 'new_val': None}]
+        )
+
+    @metrics.timed('db')
+    @uppercase_site_name
+    def get_site(self, site_name):
+        return self._get(self.connection(), site_name)
+
+    def _names(self, condition, params, page, page_size):
+        """Yields the names of the sites matching an SQL condition, sorted.
+        Names are fetched a batch at a time, every batch starting after the
+        last name of the previous one, so no cursor is held open between
+        batches."""
+        query = 'SELECT {0} FROM {1} WHERE ({2}) AND {0} > ? ORDER BY {0} ' \
+            'LIMIT ? OFFSET ?'.format(
+                self.PRIMARY_KEY, self.SITES_TABLE_NAME, condition
+            )
+        params = list(params)
+
+        if page is not None:
+            rows = self.connection().execute(
+                query, params + ['', page_size, (page - 1) * page_size]
+            )
+            for row in rows.fetchall():
+                yield row[0]
+            return
+
+        last = ''
+        while True:
+            rows = self.connection().execute(
+                query, params + [last, BATCH_SIZE, 0]
+            ).fetchall()
+            for row in rows:
+                yield row[0]
+            if len(rows) < BATCH_SIZE:
+                return
+            last = rows[-1][0]
+
+    @metrics.timed('db')
+    def list_sites(self, page=None, page_size=50):
+        return (
+            {self.PRIMARY_KEY: name}
+            for name in self._names('1', (), page, page_size)
+        )
+
+    def _list_condition(self, fields, value):
+        """An SQL condition for sites where any of the list fields has a
+        value matching `value`"""
+        conditions, params = [], []
+        for field in fields:
+            field_value = yolo_utils.uppercase_if_needed(field, value)
+            if site_index.is_pattern(field_value):
+                operator, field_value = 'GLOB', pattern_to_glob(field_value)
+            else:
+                operator = '='
+            conditions.append(
+                '{} IN (SELECT site FROM {} WHERE value {} ?)'.format(
+                    self.PRIMARY_KEY, list_table(field), operator
+                )
+            )
+            params.append(field_value)
+        return ' OR '.join(conditions), params
+
+    def _sites(self, names):
+        """Loads the sites for a stream of names, a batch at a time"""
+        batch = []
+        for name in names:
+            batch.append(name)
+            if len(batch) == BATCH_SIZE:
+                for site in self._load_sorted(batch):
+                    yield site
+                batch = []
+        for site in self._load_sorted(batch):
+            yield site
+
+    def _load_sorted(self, names):
+        sites = self._load(self.connection(), names)
+        return [sites[name] for name in names if name in sites]
+
+    @metrics.timed('db')
+    def search(self, field, value, page=None, page_size=50):
+        if field == site_index.ALL_FIELDS:
+            condition, params = self._list_condition(LIST_FIELDS, value)
+        elif sitebot_config.COLUMN_MAPPING[field] == list:
+            condition, params = self._list_condition((field,), value)
+        else:
+            condition = '{} = ?'.format(field)
+            params = [sitebot_config.COLUMN_MAPPING[field](value)]
+
+        return self._sites(self._names(condition, params, page, page_size))
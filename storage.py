@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+The interface every storage backend implements, see db.YoloDB for RethinkDB
+and sqlite_db.SqliteYoloDB for SQLite.
+
+Writes answer in the same form as a RethinkDB write run with
+return_changes=True: counts of what happened ('inserted', 'replaced',
+'unchanged', 'skipped', 'deleted', 'errors') and the old and new document
+under 'changes'.
+"""
+import functools
+
+import schema
+
+
+def uppercase_site_name(func):
+    @functools.wraps(func)
+    def wrapped(*args):
+        # args[0] = self
+        if len(args) > 2:
+            return func(args[0], args[1].upper(), *args[2:])
+        return func(args[0], args[1].upper())
+    return wrapped
+
+
+def write_response(**counts):
+    """Builds a write response, every count not given is 0"""
+    response = {
+        'inserted': 0,
+        'replaced': 0,
+        'unchanged': 0,
+        'skipped': 0,
+        'deleted': 0,
+        'errors': 0,
+        'changes': [],
+    }
+    response.update(counts)
+    return response
+
+
+class SiteStore(object):
+    """Stores site documents, keyed by their uppercase name"""
+    SITES_TABLE_NAME = 'sites'
+    PRIMARY_KEY = 'name'
+
+    # backends that keep a site_cache.SiteCache set this
+    cache = None
+
+    class AlreadyExistsError(Exception):
+        """Raised when trying to add a site that already exists in the db"""
+        pass
+
+    class InvalidField(Exception):
+        """Raised when trying to set a value on an invalid field"""
+        pass
+
+    class InvalidType(Exception):
+        pass
+
+    def close(self):
+        pass
+
+    def add_site(self, site_name):
+        """Adds a site, raises AlreadyExistsError if it's already there"""
+        raise NotImplementedError()
+
+    def add_value(self, site_name, field, value):
+        """Adds values to a list field.
+
+        :return: The new contents of the field, or None if the site doesn't
+        exist
+        """
+        raise NotImplementedError()
+
+    def remove_value(self, site_name, field, value):
+        """Removes values from a list field. Scalar fields are left alone,
+        the response says 'unchanged' (or 'skipped' if there's no such site).
+        Returns the write response."""
+        raise NotImplementedError()
+
+    def set_value(self, site_name, field, value):
+        """Replaces the value of a field. Returns the write response."""
+        raise NotImplementedError()
+
+    def delete_site(self, site_name):
+        """Deletes a site. Returns the write response."""
+        raise NotImplementedError()
+
+    def get_site(self, site_name):
+        """Returns the site document, or None"""
+        raise NotImplementedError()
+
+    def list_sites(self, page=None, page_size=50):
+        """Returns a lazy iterator over {'name': name} for every site, sorted
+        by name
+
+        :param page: Only return this page of results, starting at 1
+        :param page_size: How many sites there are on a page
+        """
+        raise NotImplementedError()
+
+    def search(self, field, value, page=None, page_size=50):
+        """Returns a lazy iterator over every site whose `field` is or
+        contains `value`, sorted by name. For list fields `value` can contain
+        * wildcards, and the field can be site_index.ALL_FIELDS to search
+        every list field.
+
+        :param page: Only return this page of results, starting at 1
+        :param page_size: How many sites there are on a page
+        """
+        raise NotImplementedError()
+
+    def validate_field(self, field, value):
+        """
+        :param field: The field that is taking a new value
+        :param value: The value to be set on the given field
+        :return: The value passed in, cast to its expected type
+        """
+        caster = schema.SCHEMA.casters.get(field)
+        if caster is None:
+            raise self.InvalidField()
+
+        try:
+            return caster(value)
+        except (ValueError, TypeError):
+            raise self.InvalidType(
+                schema.TYPE_NAMES[schema.SCHEMA.types[field]]
+            )
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+
+import pytest
+import trollius as asyncio
+
+import db
+import yolobot_plugin
+
+
+class SlowDB(object):
+    """Stands in for YoloDB, get_site blocks until the test lets it go"""
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def get_site(self, site_name):
+        self.calls.append(site_name)
+        self.release.wait(5)
+        return {'name': site_name.upper()}
+
+    def set_value(self, site_name, field, value):
+        return {'replaced': 1}
+
+
+@pytest.fixture(scope='function')
+def loop(request):
+    loop = asyncio.new_event_loop()
+    request.addfinalizer(loop.close)
+    return loop
+
+
+@pytest.fixture(scope='function')
+def slow_db():
+    return SlowDB()
+
+
+@pytest.fixture(scope='function')
+def async_db(request, loop, slow_db):
+    async_db = db.AsyncYoloDB(slow_db, loop)
+    request.addfinalizer(lambda: async_db.executor.shutdown(wait=True))
+    return async_db
+
+
+def test_identical_reads_should_share_one_query(loop, slow_db, async_db):
+    first = async_db.get_site('foo')
+    second = async_db.get_site('FOO')
+    slow_db.release.set()
+    results = loop.run_until_complete(asyncio.gather(first, second, loop=loop))
+
+    assert len(slow_db.calls) == 1
+    assert results == [{'name': 'FOO'}, {'name': 'FOO'}]
+    assert async_db.stats['coalesced'] == 1
+
+
+def test_reads_after_a_write_should_not_be_shared(loop, slow_db, async_db):
+    first = async_db.get_site('foo')
+    write = async_db.set_value('foo', 'comment', ['hi'])
+    second = async_db.get_site('foo')
+    slow_db.release.set()
+    loop.run_until_complete(asyncio.gather(first, write, second, loop=loop))
+
+    assert len(slow_db.calls) == 2
+
+
+def test_reads_should_not_be_shared_once_done(loop, slow_db, async_db):
+    slow_db.release.set()
+    loop.run_until_complete(async_db.get_site('foo'))
+    loop.run_until_complete(async_db.get_site('foo'))
+    assert len(slow_db.calls) == 2
+
+
+class FakeBot(object):
+    def __init__(self, loop, config):
+        self.loop = loop
+        self.config = config
+        self.log = logging.getLogger('test_async_db')
+        self.sent = []
+
+    def privmsg(self, target, message):
+        self.sent.append((target, message))
+
+
+def test_adding_a_site_should_forget_what_was_sent_about_it(loop, tmpdir):
+    bot = FakeBot(loop, {
+        'fish_key': 'some_key',
+        'fish_engine': 'c',
+        'db_backend': 'sqlite',
+        'sqlite_path': str(tmpdir.join('yolobot.sqlite3')),
+        'repeat_window': '60',
+    })
+    plugin = yolobot_plugin.Plugin(bot)
+    try:
+        # a !site FOO that said the site doesn't exist
+        plugin.recent[('#chan', ('!site', 'FOO'))] = loop.time()
+        plugin.replies.put('FOO', None, 'key', ['+OK old\x00'])
+
+        loop.run_until_complete(plugin.addsite('#chan', ['!addsite', 'foo']))
+        assert plugin.recent == {}
+        assert plugin.replies.get('FOO', None, 'key') is None
+    finally:
+        plugin.db.close()
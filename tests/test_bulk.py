@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import gzip
+import StringIO
+
+import pytest
+
+import storage
+from tools import bulk
+
+
+@pytest.fixture(scope='module')
+def yolodb():
+    # validating records doesn't need a database
+    return storage.SiteStore()
+
+
+def test_to_site_should_cast_and_uppercase_fields(yolodb):
+    site = bulk.to_site(yolodb, {
+        'name': 'foo',
+        'affils': 'grp1 grp2',
+        'users': ['user1', 'user2'],
+        'speed': '100',
+        'comment': '',
+    })
+    assert site == {
+        'name': 'FOO',
+        'affils': ['GRP1', 'GRP2'],
+        'users': ['user1', 'user2'],
+        'speed': 100,
+    }
+
+
+@pytest.mark.parametrize('record', [
+    {'affils': 'GRP'},
+    {'name': 'foo', 'nope': 'x'},
+    {'name': 'foo', 'speed': 'fast'},
+    {'name': 'foo', 'users': 5},
+])
+def test_to_site_should_reject_invalid_records(yolodb, record):
+    with pytest.raises(bulk.InvalidRecord):
+        bulk.to_site(yolodb, record)
+
+
+def test_read_records_should_read_jsonl(yolodb):
+    stream = StringIO.StringIO('{"name": "foo"}\n\n{"name": "bar"}\n')
+    records = [
+        (line_number, bulk.to_site(yolodb, bulk.load_record(record)))
+        for line_number, record in bulk.read_records(stream, 'jsonl')
+    ]
+    assert records == [(1, {'name': 'FOO'}), (3, {'name': 'BAR'})]
+
+
+def test_read_records_should_read_csv(yolodb):
+    stream = StringIO.StringIO(
+        'name,affils,speed\r\nfoo,grp1 grp2,10\r\nb\xc3\xa4r,,\r\n'
+    )
+    records = [
+        (line_number, bulk.to_site(yolodb, bulk.load_record(record)))
+        for line_number, record in bulk.read_records(stream, 'csv')
+    ]
+    assert records == [
+        (2, {'name': 'FOO', 'affils': ['GRP1', 'GRP2'], 'speed': 10}),
+        (3, {'name': u'BÄR'}),
+    ]
+
+
+def test_gzipped_files_should_be_decompressed(tmpdir):
+    path = str(tmpdir.join('sites.jsonl.gz'))
+    compressed = gzip.open(path, 'wb')
+    compressed.write('{"name": "foo"}\n')
+    compressed.close()
+
+    assert bulk.guess_format(path) == 'jsonl'
+    stream = bulk.open_file(path, 'rb', False)
+    try:
+        records = [
+            bulk.load_record(record)
+            for _, record in bulk.read_records(stream, 'jsonl')
+        ]
+    finally:
+        stream.close()
+    assert records == [{'name': 'foo'}]
+
+
+def test_bad_lines_should_be_counted_and_skipped(yolodb, capsys):
+    stream = StringIO.StringIO(
+        '{"name": "foo", "users": 5}\n'
+        '{"name": \n'
+        '["foo"]\n'
+    )
+    totals = bulk.import_sites(yolodb, stream, 'jsonl', 500, 'update')
+    assert totals['invalid'] == 1
+    assert totals['errors'] == 0
+    assert totals['skipped'] == 2
+    assert totals['inserted'] == 0
+
+    _, err = capsys.readouterr()
+    assert [line.split(':')[0] for line in err.splitlines()] == \
+        ['line 1', 'line 2', 'line 3']
+
+
+def test_other_backends_should_be_refused(tmpdir):
+    config = tmpdir.join('config.ini')
+    config.write('[bot]\ndb_backend = sqlite\n')
+    with pytest.raises(SystemExit) as exc:
+        bulk.main(['export', '--config', str(config), '-'])
+    assert 'db_backend is sqlite' in str(exc.value)
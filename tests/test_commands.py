@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import yolofish
+from yolobot_plugin import decrypt_command
+
+
+@pytest.fixture(scope='module')
+def fish():
+    return yolofish.YoloFish('some_key', 'c')
+
+
+def encrypt(fish, plaintext):
+    return fish.engine.encrypt(plaintext)
+
+
+def test_commands_should_be_decrypted(fish):
+    msg = decrypt_command(fish, encrypt(fish, '!site foo and a long tail'))
+    assert msg == '!site foo and a long tail'
+
+
+def test_chat_should_be_rejected(fish):
+    assert decrypt_command(fish, encrypt(fish, 'hello there, world')) is None
+    assert decrypt_command(fish, encrypt(fish, 'hi')) is None
+
+
+def test_short_commands_should_be_decrypted(fish):
+    assert decrypt_command(fish, encrypt(fish, '!sites')) == '!sites'
+
+
+def test_leading_whitespace_should_not_hide_a_command(fish):
+    msg = decrypt_command(fish, encrypt(fish, '         !sites 2'))
+    assert msg.split() == ['!sites', '2']
+
+
+def test_unprintable_chars_should_be_removed(fish):
+    assert decrypt_command(fish, encrypt(fish, '!site\x01 foo')) == '!site foo'
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 import configparser
+import time
 
 import pytest
 import rethinkdb as r
 
 import db
+import snapshot
+import sitebot_config
 
 TEST_DB = 'test'
 
@@ -101,6 +104,15 @@ def test_adding_duplicate_value_should_be_thrown_out(yolodb):
            ['user1', 'user2', 'user3']
 
 
+def test_adding_values_that_are_all_there_should_be_one_query(yolodb):
+    yolodb.add_site('foo')
+    yolodb.set_value('foo', 'users', ['user1', 'user2'])
+    stats = yolodb.pool.stats
+    checkouts = stats['hits'] + stats['connects']
+    assert yolodb.add_value('foo', 'users', ['user1']) == ['user1', 'user2']
+    assert stats['hits'] + stats['connects'] == checkouts + 1
+
+
 def test_delsite_should_remove_site_from_the_database(yolodb):
     yolodb.add_site('foo')
     response = yolodb.delete_site('foo')
@@ -126,7 +138,9 @@ def test_removing_a_non_list_value_should_no_op(yolodb):
     yolodb.add_site('foo')
     fixture = 'this is a comment'
     yolodb.set_value('foo', 'comment', [fixture])
-    yolodb.remove_value('foo', 'comment', 'blah')
+    response = yolodb.remove_value('foo', 'comment', 'blah')
+    assert response['errors'] == 0
+    assert response['unchanged'] == 1
     assert yolodb.get_site('foo')['comment'] == fixture
 
 
@@ -141,7 +155,7 @@ def test_search_should_work(yolodb):
     yolodb.set_value('foo', 'users', ['user1', 'user2'])
     yolodb.set_value('bar', 'users', ['user1'])
     result = yolodb.search('users', 'user1')
-    assert len(result) == 2
+    assert len(list(result)) == 2
 
 
 def test_should_return_results_sorted(yolodb):
@@ -161,4 +175,128 @@ def test_should_return_results_sorted(yolodb):
 
 def test_search_with_no_results(yolodb):
     result = yolodb.search('users', 'user1')
-    assert result == []
+    assert list(result) == []
+
+
+def test_list_sites_should_be_paginated(yolodb):
+    for site in ['foo', 'bar', 'baz', 'alpha']:
+        yolodb.add_site(site)
+
+    pages = [
+        [site['name'] for site in yolodb.list_sites(page, 3)]
+        for page in (1, 2, 3)
+    ]
+    assert pages == [['ALPHA', 'BAR', 'BAZ'], ['FOO'], []]
+
+
+def test_search_should_be_paginated(yolodb):
+    for site in ['foo', 'bar', 'baz']:
+        yolodb.add_site(site)
+        yolodb.set_value(site, 'users', ['user1'])
+
+    result = yolodb.search('users', 'user1', 2, 2)
+    assert [site['name'] for site in result] == ['FOO']
+
+
+def test_connections_should_be_reused(yolodb):
+    yolodb.add_site('foo')
+    connects = yolodb.pool.stats['connects']
+    yolodb.get_site('foo')
+    list(yolodb.list_sites())
+    assert yolodb.pool.stats['connects'] == connects
+    assert yolodb.pool.stats['hits'] >= 2
+
+
+def test_expired_connections_should_be_replaced(yolodb):
+    yolodb.pool.idle_timeout = -1
+    yolodb.get_site('foo')
+    assert yolodb.pool.stats['expired'] >= 1
+
+
+def test_removing_from_a_field_that_isnt_set_should_not_error(yolodb):
+    yolodb.add_site('foo')
+    result = yolodb.remove_value('foo', 'users', ['user1'])
+    assert result['errors'] == 0
+    assert yolodb.get_site('foo')['users'] == []
+
+
+def test_add_value_should_return_none_for_a_non_existent_site(yolodb):
+    assert yolodb.add_value('foo', 'users', ['user1']) is None
+
+
+def test_mutations_should_return_the_new_document(yolodb):
+    yolodb.add_site('foo')
+    result = yolodb.set_value('foo', 'comment', ['a', 'comment'])
+    assert result['changes'][0]['new_val']['comment'] == 'a comment'
+
+
+def test_every_field_should_have_an_index(yolodb):
+    expected = set(sitebot_config.COLUMN_MAPPING) - set([yolodb.PRIMARY_KEY])
+    assert yolodb.indexes >= expected
+
+
+def test_search_on_a_scalar_field_should_work(yolodb):
+    yolodb.add_site('foo')
+    yolodb.add_site('bar')
+    yolodb.set_value('foo', 'speed', ['100'])
+    result = yolodb.search('speed', '100')
+    assert [site['name'] for site in result] == ['FOO']
+
+
+@pytest.fixture(scope='function')
+def cached_yolodb(request):
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+
+    yolodb = db.YoloDB(config['bot']['db_host'], TEST_DB, cache=True)
+    request.addfinalizer(yolodb.close)
+    for _ in range(50):
+        if yolodb.cache.ready:
+            break
+        time.sleep(0.1)
+    return yolodb
+
+
+def test_cache_should_answer_reads_after_writes(cached_yolodb):
+    assert cached_yolodb.cache.staleness() == 0
+    cached_yolodb.add_site('foo')
+    cached_yolodb.add_value('foo', 'users', ['user1'])
+    assert cached_yolodb.get_site('foo')['users'] == ['user1']
+    assert [s['name'] for s in cached_yolodb.search('users', 'user1')] == \
+        ['FOO']
+
+    cached_yolodb.delete_site('foo')
+    assert cached_yolodb.get_site('foo') is None
+    assert list(cached_yolodb.list_sites()) == []
+
+
+def test_snapshot_should_be_revalidated_in_the_background(yolodb, tmpdir):
+    path = str(tmpdir.join('yolobot.snapshot'))
+    snapshot.write(path, [{'name': 'GONE'}])
+    yolodb.add_site('foo')
+
+    warm = db.YoloDB(yolodb.host, TEST_DB, snapshot_path=path)
+    for _ in range(50):
+        if warm.snapshot is None:
+            break
+        time.sleep(0.1)
+    assert warm.get_site('gone') is None
+    assert snapshot.Snapshot(path).get_site('FOO') == {'name': 'FOO'}
+    warm.close()
+
+
+def test_the_first_snapshot_should_be_written_after_setup(yolodb, tmpdir):
+    path = tmpdir.join('yolobot.snapshot')
+    yolodb.add_site('foo')
+
+    cold = db.YoloDB(yolodb.host, TEST_DB, snapshot_path=str(path))
+    for _ in range(50):
+        if path.check():
+            break
+        time.sleep(0.1)
+    assert snapshot.Snapshot(str(path)).get_site('FOO') == {'name': 'FOO'}
+
+    # without the site cache, close writes it from the table
+    cold.add_site('bar')
+    cold.close()
+    assert snapshot.Snapshot(str(path)).get_site('BAR') == {'name': 'BAR'}
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import configparser
+import ctypes
 
 import pytest
 
@@ -11,12 +12,119 @@ def fish():
     config = configparser.ConfigParser()
     config.read('config.ini')
 
-    return yolofish.YoloFish(config['bot']['fish_key'])
+    return yolofish.YoloFish(config['bot']['fish_key'], 'c')
+
+
+@pytest.fixture(scope='module')
+def numpy_fish(fish):
+    pytest.importorskip('numpy')
+    return yolofish.YoloFish(fish.key, 'numpy')
 
 
 def test_encrypting_a_long_string_should_work(fish):
-    fixture = 'this is a test' * 22
+    fixture = 'this is a test' * 30
     encrypted = fish.encrypt(fixture)
 
     final_string = ' '.join(fish.decrypt(msg[4:])for msg in encrypted)
     assert final_string == fixture
+
+
+def test_split_pieces_should_fill_the_budget(fish):
+    words = ['word{}'.format(i) for i in range(200)]
+    pieces = fish.split(' '.join(words), 40)
+    assert all(len(piece) <= 40 for piece in pieces)
+    assert ' '.join(pieces).split() == words
+    # no piece has room left for the first word of the next one
+    for piece, next_piece in zip(pieces, pieces[1:]):
+        assert len(piece) + 1 + len(next_piece.split()[0]) > 40
+
+
+def test_split_should_cut_long_words_between_utf8_characters(fish):
+    pieces = fish.split(u'ab ' + u'\xe4' * 20, 9)
+    assert all(len(piece) <= 9 for piece in pieces)
+    assert pieces[0] == 'ab \xc3\xa4\xc3\xa4\xc3\xa4'
+    assert ''.join(p.decode('utf-8') for p in pieces[1:]) == u'\xe4' * 17
+
+
+def test_split_should_not_cut_a_character_to_fill_a_piece(fish):
+    pieces = fish.split(u'abcdefg ' + u'\xe4' * 20, 9)
+    assert all(len(piece) <= 9 for piece in pieces)
+    assert pieces[0] == 'abcdefg'
+    assert ''.join(p.decode('utf-8') for p in pieces[1:]) == u'\xe4' * 20
+
+
+def test_messages_should_fit_in_an_irc_line(fish):
+    channel = '#a_rather_long_channel_name'
+    budget = yolofish.plaintext_budget(yolofish.message_budget(channel))
+    prefix = ':' + 'n' * (yolofish.RELAY_PREFIX_LENGTH - 2) + ' '
+    for message in fish.encrypt_many(['x' * 1000], budget):
+        line = '{}PRIVMSG {} :{}\r\n'.format(prefix, channel, message)
+        assert len(line) <= yolofish.IRC_LINE_LENGTH
+    assert len(fish.split('x' * 1000, budget)) == 4
+
+
+def test_cached_context_should_match_one_shot_encryption(fish):
+    fixture = 'short msg'
+    buffer_size = 64
+    c_memory_block = ctypes.create_string_buffer(buffer_size)
+    fish.engine.fish.encrypt_string(
+        ctypes.c_char_p(fish.key),
+        ctypes.c_char_p(fixture),
+        c_memory_block,
+        len(fixture)
+    )
+    assert fish._encrypt(fixture) == '+OK {}\x00'.format(c_memory_block.value)
+    assert fish.decrypt(c_memory_block.value) == fixture
+
+
+def test_batch_encryption_should_match_single_encryption(fish):
+    fixtures = ['a', 'this is a test', '', 'x' * 17]
+    assert fish.encrypt_many(fixtures) == [fish._encrypt(f) for f in fixtures]
+
+
+def test_batch_decryption_should_round_trip(fish):
+    fixtures = ['a', 'this is a test', 'this is a test' * 30]
+    encrypted = fish.encrypt_many(fixtures)
+    assert len(encrypted) == 4
+
+    decrypted = fish.decrypt_many([msg[4:-1] for msg in encrypted])
+    assert decrypted[:2] == fixtures[:2]
+    assert ' '.join(decrypted[2:]) == fixtures[2]
+
+
+def test_numpy_engine_should_match_the_c_library(fish, numpy_fish):
+    fixtures = [
+        '',
+        'a',
+        'exactly8',
+        '!site FOO',
+        '\x02Name:\x02 FOO \xe2\x98\x83 unicode',
+        ''.join(chr(i) for i in range(1, 256)),
+        'this is a test' * 22,
+    ]
+    encrypted = fish.encrypt_many(fixtures)
+    assert numpy_fish.encrypt_many(fixtures) == encrypted
+
+    cipher_texts = [msg[4:-1] for msg in encrypted] + ['bogus!', 'abc' * 5]
+    assert numpy_fish.decrypt_many(cipher_texts) == \
+        fish.decrypt_many(cipher_texts)
+
+
+def test_keyring_should_look_up_keys_by_channel(fish):
+    keyring = yolofish.FishKeyring(fish.key, {'other': 'otherkey'})
+    assert keyring.get('#somechan').key == fish.key
+    assert keyring.get('#OTHER').key == 'otherkey'
+    assert keyring.get('#other') is keyring.get('#Other')
+
+
+def test_keyring_should_evict_least_recently_used_contexts(fish):
+    keyring = yolofish.FishKeyring(
+        None, {'one': 'key1', 'two': 'key2', 'three': 'key3'}, max_contexts=2
+    )
+    one = keyring.get('#one')
+    keyring.get('#two')
+    assert keyring.get('#one') is one
+
+    keyring.get('#three')
+    assert keyring.get('#one') is one
+    assert keyring.get('#nokey') is None
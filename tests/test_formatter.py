@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from yolobot_plugin import BOLD, Formatter
+
+
+def test_format_site_should_follow_the_layout():
+    formatter = Formatter(
+        (('Name',), ('Speed', 'Users')),
+        {
+            'Name': {'type': str, 'column_name': 'name'},
+            'Speed': {'type': int, 'column_name': 'speed'},
+            'Users': {'type': list, 'column_name': 'users'},
+        }
+    )
+    site = {'name': 'FOO', 'users': ['bob', 'alice']}
+    assert formatter.format_site(site) == [
+        '{0}Name{0}: FOO'.format(BOLD),
+        '{0}Speed{0}:  {0}Users{0}: alice bob'.format(BOLD),
+    ]
+
+
+def test_format_site_should_not_change_the_site():
+    site = {'name': 'FOO', 'users': ['bob', 'alice']}
+    Formatter().format_site(site)
+    assert site['users'] == ['bob', 'alice']
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import logging
+import sys
+
+import pytest
+import trollius as asyncio
+
+import hot_reload
+import yolobot_plugin
+
+
+@pytest.fixture(scope='function')
+def modules(request, tmpdir):
+    """Two throwaway modules, the second one importing the first"""
+    tmpdir.join('reload_base.py').write('VALUE = 1\n')
+    tmpdir.join('reload_user.py').write('import reload_base\n')
+    sys.path.insert(0, str(tmpdir))
+
+    def remove():
+        sys.path.remove(str(tmpdir))
+        for name in ('reload_base', 'reload_user'):
+            sys.modules.pop(name, None)
+    request.addfinalizer(remove)
+
+    import reload_base
+    import reload_user
+    hot_reload.track(reload_base, reload_user)
+    return tmpdir, reload_base, reload_user
+
+
+def test_unchanged_modules_should_not_be_reloaded(modules):
+    _, base, user = modules
+    assert hot_reload.reload_changed([base, user]) == set()
+
+
+def test_importers_of_a_changed_module_should_be_reloaded(modules):
+    tmpdir, base, user = modules
+    tmpdir.join('reload_base.py').write('VALUE = 2\n')
+    # the .pyc could have the same mtime as the new source
+    compiled = tmpdir.join('reload_base.pyc')
+    if compiled.check():
+        compiled.remove()
+
+    assert hot_reload.reload_changed([base, user]) == \
+        set(['reload_base', 'reload_user'])
+    assert base.VALUE == 2
+    assert hot_reload.reload_changed([base, user]) == set()
+
+
+class FakeBot(object):
+    def __init__(self, loop, config):
+        self.loop = loop
+        self.config = config
+        self.log = logging.getLogger('test_hot_reload')
+        self.sent = []
+
+    def privmsg(self, target, message):
+        self.sent.append((target, message))
+
+
+@pytest.fixture(scope='function')
+def bot(request, tmpdir):
+    loop = asyncio.new_event_loop()
+    request.addfinalizer(loop.close)
+    return FakeBot(loop, {
+        'fish_key': 'some_key',
+        'fish_engine': 'c',
+        'db_backend': 'sqlite',
+        'sqlite_path': str(tmpdir.join('yolobot.sqlite3')),
+    })
+
+
+def test_reload_should_keep_the_state_of_unchanged_modules(bot):
+    plugin = yolobot_plugin.Plugin(bot)
+    plugin.keyring.get('#chan')
+    new = yolobot_plugin.Plugin.reload(plugin)
+
+    assert new is not plugin
+    assert new.db is plugin.db
+    assert new.keyring is plugin.keyring
+    assert new.outbox is plugin.outbox
+    assert new.replies is plugin.replies
+    new.db.close()
+
+
+def test_reload_should_rebuild_state_whose_options_changed(bot):
+    plugin = yolobot_plugin.Plugin(bot)
+    plugin.outbox.put('#chan', ['queued before the reload'])
+    bot.config['flood_rate'] = '2'
+    new = yolobot_plugin.Plugin.reload(plugin)
+
+    assert new.outbox is not plugin.outbox
+    assert new.outbox.bucket.rate == 2
+    assert new.outbox.depth() == 1 and plugin.outbox.depth() == 0
+    assert new.db is plugin.db
+    new.db.close()
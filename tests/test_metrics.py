@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import metrics
+import sqlite_db
+
+
+@pytest.fixture(scope='function')
+def registry():
+    registry = metrics.Registry()
+    registry.describe('db', 'op', 'Time taken by YoloDB methods')
+    return registry
+
+
+def test_percentiles_should_land_in_the_right_bucket():
+    histogram = metrics.Histogram()
+    for _ in range(90):
+        histogram.observe(0.001)
+    for _ in range(10):
+        histogram.observe(1.0)
+
+    assert 0.0008 <= histogram.percentile(0.5) <= 0.0016
+    assert 0.8 <= histogram.percentile(0.99) <= 1.7
+
+
+def test_timed_should_count_calls_and_errors(registry):
+    @metrics.timed('db', registry=registry)
+    def get_site(fail):
+        if fail:
+            raise ValueError()
+        return 'site'
+
+    assert get_site(False) == 'site'
+    with pytest.raises(ValueError):
+        get_site(True)
+
+    [(label, count, errors, _, _, _)] = list(registry.summary('db'))
+    assert (label, count, errors) == ('get_site', 2, 1)
+
+
+def test_db_metrics_should_be_labelled_by_method(tmpdir):
+    # the methods are also wrapped by uppercase_site_name
+    yolodb = sqlite_db.SqliteYoloDB(str(tmpdir.join('yolobot.sqlite3')))
+    try:
+        yolodb.add_site('foo')
+        yolodb.get_site('foo')
+    finally:
+        yolodb.close()
+
+    labels = set(summary[0] for summary in metrics.REGISTRY.summary('db'))
+    assert set(['add_site', 'get_site']) <= labels
+    assert 'wrapped' not in labels
+
+
+def test_render_should_use_the_prometheus_text_format(registry):
+    registry.observe('db', 'get_site', 0.003)
+    registry.register_stats('outbox', {'depth': 4, 'name': 'ignored'})
+    text = registry.render()
+
+    assert '# TYPE yolobot_db_seconds histogram' in text
+    assert 'yolobot_db_seconds_bucket{op="get_site",le="0.0016"} 0' in text
+    assert 'yolobot_db_seconds_bucket{op="get_site",le="0.0032"} 1' in text
+    assert 'yolobot_db_seconds_bucket{op="get_site",le="+Inf"} 1' in text
+    assert 'yolobot_db_seconds_count{op="get_site"} 1' in text
+    assert 'yolobot_db_errors_total{op="get_site"} 0' in text
+    assert 'yolobot_outbox_depth 4' in text
+    assert 'ignored' not in text
+
+
+def test_write_should_replace_the_file(registry, tmpdir):
+    path = str(tmpdir.join('yolobot.prom'))
+    registry.observe('db', 'get_site', 0.003)
+    registry.write(path)
+    assert open(path).read() == registry.render()
+
+
+def test_timed_generators_should_count_the_time_spent_in_them(
+        registry, monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(metrics, 'now', lambda: clock[0])
+
+    @metrics.timed('db', registry=registry)
+    def list_sites():
+        for name in ('FOO', 'BAR'):
+            clock[0] += 0.5
+            yield name
+
+    sites = list_sites()
+    assert list(registry.summary('db')) == []
+    assert next(sites) == 'FOO'
+    # the caller's own time isn't the query's
+    clock[0] += 10
+    assert list(sites) == ['BAR']
+
+    histogram = registry.histograms['db']['list_sites']
+    assert (histogram.count, histogram.errors) == (1, 0)
+    assert histogram.total == 1.0
+
+    sites = list_sites()
+    next(sites)
+    sites.close()
+    assert histogram.count == 2
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import outbound
+import yolofish
+
+
+class FakeLoop(object):
+    """Runs callbacks when the test says so, with a clock it controls"""
+    def __init__(self):
+        self.now = 0.0
+        self.callbacks = []
+
+    def time(self):
+        return self.now
+
+    def call_soon(self, callback):
+        return self.call_later(0, callback)
+
+    def call_later(self, delay, callback):
+        self.callbacks.append((self.now + delay, callback))
+        return self
+
+    def cancel(self):
+        self.callbacks = []
+
+    def advance(self, seconds):
+        self.now += seconds
+        callbacks, self.callbacks = self.callbacks, []
+        for when, callback in callbacks:
+            if when > self.now:
+                self.callbacks.append((when, callback))
+                continue
+            callback()
+
+
+@pytest.fixture(scope='function')
+def loop():
+    return FakeLoop()
+
+
+@pytest.fixture(scope='function')
+def sent():
+    return []
+
+
+@pytest.fixture(scope='function')
+def outbox(loop, sent):
+    keyring = yolofish.FishKeyring('some_key', engine='c')
+    return outbound.OutboundQueue(
+        lambda target, msg: sent.append((target, msg)),
+        keyring,
+        loop,
+        rate=1,
+        burst=2
+    )
+
+
+def decrypt(sent):
+    fish = yolofish.YoloFish('some_key', 'c')
+    return [(target, fish.decrypt(msg[4:])) for target, msg in sent]
+
+
+def test_short_lines_should_be_packed_together(outbox, loop, sent):
+    outbox.put('#chan', ['one', 'two', 'three'])
+    loop.advance(0)
+    assert decrypt(sent) == [('#chan', 'one | two | three')]
+    assert outbox.stats['packed'] == 2
+
+
+def test_packed_lines_should_fit_in_one_message(outbox, loop, sent):
+    line = 'x' * 200
+    outbox.put('#chan', [line, line])
+    loop.advance(0)
+    assert decrypt(sent) == [('#chan', line), ('#chan', line)]
+    assert all(len(msg) <= 490 for _, msg in sent)
+
+
+def test_sends_should_be_paced_by_the_token_bucket(outbox, loop, sent):
+    outbox.put('#chan', ['x' * 250] * 4)
+    loop.advance(0)
+    assert len(sent) == 2
+    assert outbox.depth() == 2
+    assert outbox.stats['delayed'] == 1
+
+    loop.advance(1)
+    assert len(sent) == 3
+    loop.advance(1)
+    assert len(sent) == 4
+    assert outbox.depth() == 0
+
+
+def test_targets_should_take_turns(outbox, loop, sent):
+    outbox.put('#one', ['x' * 250] * 2)
+    outbox.put('#two', ['y' * 250])
+    loop.advance(0)
+    assert [target for target, _ in sent] == ['#one', '#two']
+
+
+def test_lines_for_targets_without_a_key_should_be_dropped(loop, sent):
+    outbox = outbound.OutboundQueue(
+        lambda target, msg: sent.append((target, msg)),
+        yolofish.FishKeyring(),
+        loop
+    )
+    outbox.put('#chan', ['secret'])
+    loop.advance(0)
+    assert sent == []
+    assert outbox.stats['dropped'] == 1
+
+
+def test_encrypted_messages_should_be_sent_as_is(outbox, loop, sent):
+    fish = yolofish.YoloFish('some_key', 'c')
+    messages = fish.encrypt_many(outbox.pack('#chan', ['one', 'two']))
+    outbox.put('#chan', ['before'])
+    outbox.put_encrypted('#chan', messages)
+    loop.advance(0)
+    assert decrypt(sent) == [('#chan', 'before'), ('#chan', 'one | two')]
+
+
+def test_taken_over_lines_should_fit_the_new_budget(outbox, loop, sent):
+    line = ' '.join(['word'] * 60)
+    outbox.put('#chan', [line])
+    new_outbox = outbound.OutboundQueue(
+        lambda target, msg: sent.append((target, msg)),
+        outbox.keyring,
+        loop,
+        rate=1,
+        burst=2,
+        max_length=200
+    )
+    new_outbox.take_over(outbox)
+    loop.advance(0)
+    assert all(len(msg) <= 200 for _, msg in sent)
+    assert ' '.join(text for _, text in decrypt(sent)) == line
+
+
+def test_relayed_messages_should_fit_in_an_irc_line(outbox, loop, sent):
+    outbox.put('#chan', [' '.join(['word'] * 300)])
+    loop.advance(10)
+    prefix = ':' + 'n' * (yolofish.RELAY_PREFIX_LENGTH - 2) + ' '
+    for target, message in sent:
+        line = '{}PRIVMSG {} :{}\r\n'.format(prefix, target, message)
+        assert len(line) <= yolofish.IRC_LINE_LENGTH
+
+    no_prefix = outbound.OutboundQueue(
+        None, outbox.keyring, loop, relay_prefix_length=0
+    )
+    assert no_prefix.line_budget('#chan') > outbox.line_budget('#chan')
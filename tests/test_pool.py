@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import pytest
+import rethinkdb as r
+
+import db
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = False
+
+    def check_open(self):
+        if self.closed:
+            raise r.errors.RqlDriverError('closed')
+
+    def close(self, noreply_wait=True):
+        self.closed = True
+
+
+@pytest.fixture(scope='function')
+def pool(monkeypatch):
+    monkeypatch.setattr(r, 'connect', lambda *args, **kwargs: FakeConnection())
+    return db.ConnectionPool('localhost', 'test')
+
+
+def test_connections_should_be_released_when_a_generator_is_closed(pool):
+    def hold():
+        with pool.connection() as conn:
+            yield conn
+
+    generator = hold()
+    conn = next(generator)
+    generator.close()
+    assert [idle for idle, _ in pool._idle] == [conn]
+
+
+def test_broken_connections_should_be_closed(pool):
+    with pytest.raises(r.errors.RqlDriverError):
+        with pool.connection() as conn:
+            raise r.errors.RqlDriverError('gone')
+    assert conn.closed
+    assert pool._idle == []
+    assert pool.stats['failures'] == 1
+
+
+class FakeQuery(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def run(self, conn):
+        return iter(self.rows)
+
+
+def test_closing_a_partly_read_stream_should_release_its_connection(pool):
+    # a YoloDB that never connects for setup
+    yolodb = db.YoloDB.__new__(db.YoloDB)
+    yolodb.pool = pool
+
+    results = yolodb._stream(FakeQuery([{'name': 'FOO'}, {'name': 'BAR'}]),
+                             'test')
+    assert next(results) == {'name': 'FOO'}
+    assert pool._idle == []
+
+    results.close()
+    assert len(pool._idle) == 1
+    assert pool.stats['failures'] == 0
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import reply_cache
+
+
+def test_a_cached_reply_should_be_returned():
+    cache = reply_cache.ReplyCache()
+    cache.put('FOO', 'rev1', 'key', ['+OK abc'])
+    assert cache.get('FOO', 'rev1', 'key') == ('+OK abc',)
+    assert cache.get('FOO', 'rev1', 'other key') is None
+    assert cache.get('FOO', 'rev2', 'key') is None
+
+
+def test_the_revision_should_change_with_the_site():
+    site = {'name': 'FOO', 'users': ['bob']}
+    revision = reply_cache.site_revision(site)
+    assert reply_cache.site_revision(dict(site)) == revision
+    assert reply_cache.site_revision(
+        {'name': 'FOO', 'users': ['bob', 'alice']}
+    ) != revision
+
+
+def test_a_new_revision_should_replace_the_old_one():
+    cache = reply_cache.ReplyCache()
+    cache.put('FOO', 'rev1', 'key', ['old'])
+    cache.put('FOO', 'rev2', 'key', ['new'])
+    assert len(cache) == 1
+
+
+def test_invalidate_should_drop_every_entry_of_the_site():
+    cache = reply_cache.ReplyCache()
+    cache.put('FOO', 'rev1', 'key', ['one'])
+    cache.put('FOO', 'rev1', 'other key', ['two'])
+    cache.put('BAR', 'rev1', 'key', ['three'])
+    cache.invalidate('FOO')
+    assert cache.get('FOO', 'rev1', 'key') is None
+    assert len(cache) == 1
+
+
+def test_the_least_recently_used_reply_should_be_evicted():
+    cache = reply_cache.ReplyCache(max_size=2)
+    cache.put('FOO', 'rev1', 'key', ['foo'])
+    cache.put('BAR', 'rev1', 'key', ['bar'])
+    cache.get('FOO', 'rev1', 'key')
+    cache.put('BAZ', 'rev1', 'key', ['baz'])
+    assert cache.get('BAR', 'rev1', 'key') is None
+    assert cache.get('FOO', 'rev1', 'key') == ('foo',)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import sys
+
+import pytest
+
+import schema
+import site_cache
+import storage
+
+SITE = {
+    'name': 'FOO',
+    'affils': ['GRP1', 'GRP2'],
+    'users': ['user1'],
+    'speed': 100,
+}
+
+
+@pytest.fixture(scope='function')
+def site_schema():
+    return schema.Schema(
+        {
+            'Name': {'type': str, 'column_name': 'name'},
+            'Affils': {'type': list, 'column_name': 'affils'},
+            'Users': {'type': list, 'column_name': 'users'},
+            'Speed': {'type': int, 'column_name': 'speed'},
+            'Size': {'type': float, 'column_name': 'size'},
+        },
+        ('name', 'affils'),
+    )
+
+
+def test_casters_should_cast_and_uppercase(site_schema):
+    casters = site_schema.casters
+    assert casters['affils'](['grp1', 'Grp2']) == ['GRP1', 'GRP2']
+    assert casters['users'](['User1']) == ['User1']
+    assert casters['name'](['foo', 'bar']) == 'FOO BAR'
+    assert casters['speed'](['100']) == 100
+    assert casters['size'](['1.5']) == 1.5
+    with pytest.raises(ValueError):
+        casters['speed'](['fast'])
+
+
+def test_validate_field_should_name_the_expected_type():
+    store = storage.SiteStore()
+    assert store.validate_field('speed', ['100']) == 100
+    with pytest.raises(store.InvalidType) as exc:
+        store.validate_field('speed', ['fast'])
+    assert str(exc.value) == 'integer'
+    with pytest.raises(store.InvalidField):
+        store.validate_field('nope', ['1'])
+
+
+def test_site_records_should_read_like_the_document(site_schema):
+    site = site_schema.Site.from_dict(dict(SITE, legacy='kept'))
+    assert site['name'] == 'FOO'
+    assert site.get('affils') == ('GRP1', 'GRP2')
+    assert site.get('size') is None
+    assert 'speed' in site and 'size' not in site
+    with pytest.raises(KeyError):
+        site['size']
+    assert site.to_dict() == dict(SITE, legacy='kept')
+    assert site == dict(SITE, legacy='kept')
+
+
+def test_to_dict_should_hand_out_copies(site_schema):
+    site = site_schema.Site.from_dict(SITE)
+    site.to_dict()['affils'].append('GRP3')
+    assert site.get('affils') == ('GRP1', 'GRP2')
+
+
+def test_list_values_should_be_shared_between_records(site_schema):
+    values = [''.join(['G', '1']) for _ in range(2)]
+    assert values[0] is not values[1]
+    interned = {}
+    first = site_schema.Site.from_dict(
+        {'name': 'A', 'affils': values[:1]}, interned
+    )
+    second = site_schema.Site.from_dict(
+        {'name': 'B', 'affils': values[1:]}, interned
+    )
+    assert first.get('affils')[0] is second.get('affils')[0]
+    assert interned == {'G1': 'G1'}
+
+
+def test_the_site_cache_should_only_intern_on_reload():
+    values = [''.join(['G', '1']) for _ in range(4)]
+    cache = site_cache.SiteCache(None)
+    cache.reload([
+        {'name': 'A', 'affils': values[:1]},
+        {'name': 'B', 'affils': values[1:2]},
+    ])
+    assert cache.sites['A'].affils[0] is cache.sites['B'].affils[0]
+
+    # changes are stored as they are, nothing keeps their values around
+    cache.apply(None, {'name': 'C', 'affils': values[2:3]})
+    cache.apply(None, {'name': 'D', 'affils': values[3:]})
+    assert cache.sites['C'].affils[0] is not cache.sites['D'].affils[0]
+
+
+def test_site_records_should_be_smaller_than_dicts(site_schema):
+    site = site_schema.Site.from_dict(SITE)
+    assert not hasattr(site, '__dict__')
+    assert sys.getsizeof(site) < sys.getsizeof(dict(SITE))
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import site_index
+
+
+@pytest.fixture(scope='function')
+def index():
+    index = site_index.SiteIndex()
+    index.rebuild([
+        {'name': 'FOO', 'affils': ['GRP1', 'GRP2'], 'users': ['bob']},
+        {'name': 'BAR', 'affils': ['GRP10', 'OTHER'], 'users': ['alice']},
+        {'name': 'BAZ', 'allows': ['GRP1']},
+    ])
+    return index
+
+
+def test_exact_search_should_only_match_whole_values(index):
+    assert index.search('affils', 'GRP1') == set(['FOO'])
+
+
+def test_prefix_search_should_match_every_value_with_the_prefix(index):
+    assert index.search('affils', 'GRP*') == set(['FOO', 'BAR'])
+    assert index.search('affils', 'NOPE*') == set()
+
+
+def test_substring_search_should_work(index):
+    assert index.search('affils', '*TH*') == set(['BAR'])
+    assert index.search('affils', '*1') == set(['FOO'])
+
+
+def test_searching_all_fields_should_uppercase_where_needed(index):
+    assert index.search(site_index.ALL_FIELDS, 'grp1') == set(['FOO', 'BAZ'])
+    assert index.search(site_index.ALL_FIELDS, 'ali*') == set(['BAR'])
+
+
+def test_updates_should_be_incremental(index):
+    index.update(
+        {'name': 'FOO', 'affils': ['GRP1', 'GRP2']},
+        {'name': 'FOO', 'affils': ['GRP3']}
+    )
+    assert index.search('affils', 'GRP*') == set(['FOO', 'BAR'])
+    assert index.search('affils', 'GRP2') == set()
+
+    index.update({'name': 'BAR', 'affils': ['GRP10', 'OTHER']}, None)
+    assert index.search('affils', '*') == set(['FOO'])
+    assert index.tries['affils'].root.children.keys() == ['G']
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import db
+import site_index
+import snapshot
+import storage
+
+SITES = [
+    {'name': 'FOO', 'users': ['user1', 'user2'], 'affils': ['GRP1'],
+     'speed': 100},
+    {'name': 'BAR', 'users': ['user1'], 'affils': ['GRP2']},
+    {'name': u'BÄZ', 'users': [u'üser'], 'affils': []},
+]
+
+
+@pytest.fixture(scope='function')
+def site_snapshot(request, tmpdir):
+    path = str(tmpdir.join('yolobot.snapshot'))
+    snapshot.write(path, SITES)
+    site_snapshot = snapshot.Snapshot(path)
+    request.addfinalizer(site_snapshot.close)
+    return site_snapshot
+
+
+def names(sites):
+    return [site['name'] for site in sites]
+
+
+def test_snapshot_should_return_the_sites(site_snapshot):
+    assert len(site_snapshot) == 3
+    assert site_snapshot.get_site('FOO') == SITES[0]
+    assert site_snapshot.get_site(u'BÄZ') == SITES[2]
+    assert site_snapshot.get_site('FO') is None
+    assert site_snapshot.get_site('ZZZ') is None
+    assert names(site_snapshot.list_sites()) == ['BAR', u'BÄZ', 'FOO']
+
+
+def test_snapshot_search_should_use_the_index(site_snapshot):
+    assert names(site_snapshot.search('users', 'user1', list)) == \
+        ['BAR', 'FOO']
+    assert names(site_snapshot.search('users', 'user*', list)) == \
+        ['BAR', 'FOO']
+    assert names(site_snapshot.search('users', '*2', list)) == ['FOO']
+    assert names(site_snapshot.search('users', u'ü*', list)) == [u'BÄZ']
+    assert names(site_snapshot.search('users', 'nobody', list)) == []
+    assert names(site_snapshot.search(
+        site_index.ALL_FIELDS, 'grp*', list
+    )) == ['BAR', 'FOO']
+    assert names(site_snapshot.search('speed', 100, int)) == ['FOO']
+
+
+def test_an_empty_snapshot_should_work(tmpdir):
+    path = str(tmpdir.join('yolobot.snapshot'))
+    snapshot.write(path, [])
+    empty = snapshot.Snapshot(path)
+    assert empty.list_sites() == []
+    assert empty.get_site('FOO') is None
+    assert empty.search('users', 'user*', list) == []
+
+
+@pytest.mark.parametrize('contents', ['', 'not a snapshot', None])
+def test_invalid_snapshots_should_be_rejected(tmpdir, contents):
+    path = str(tmpdir.join('yolobot.snapshot'))
+    if contents is None:
+        # a truncated snapshot
+        snapshot.write(path, SITES)
+        with open(path, 'rb') as snapshot_file:
+            contents = snapshot_file.read()[:-10]
+    with open(path, 'wb') as snapshot_file:
+        snapshot_file.write(contents)
+
+    with pytest.raises(snapshot.Snapshot.InvalidSnapshot):
+        snapshot.Snapshot(path)
+
+
+def test_a_write_should_unmap_the_snapshot(site_snapshot):
+    # a YoloDB that never connects for setup
+    yolodb = db.YoloDB.__new__(db.YoloDB)
+    yolodb.snapshot = site_snapshot
+    yolodb._cache_response(storage.write_response(replaced=1))
+
+    assert yolodb.snapshot is None
+    with pytest.raises(ValueError):
+        site_snapshot.get_site('FOO')
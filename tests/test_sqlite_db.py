@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import sqlite_db
+
+
+@pytest.fixture(scope='function')
+def yolodb(request, tmpdir):
+    yolodb = sqlite_db.SqliteYoloDB(str(tmpdir.join('yolobot.sqlite3')))
+    request.addfinalizer(yolodb.close)
+    return yolodb
+
+
+def names(sites):
+    return [site['name'] for site in sites]
+
+
+def test_site_should_get_persisted_to_database(yolodb):
+    yolodb.add_site('foo')
+    assert yolodb.get_site('foo')['name'] == 'FOO'
+    assert yolodb.get_site('bar') is None
+
+
+def test_adding_a_site_twice_should_raise(yolodb):
+    yolodb.add_site('foo')
+    with pytest.raises(yolodb.AlreadyExistsError):
+        yolodb.add_site('foo')
+
+
+def test_add_value_should_return_the_new_field(yolodb):
+    yolodb.add_site('foo')
+    assert yolodb.add_value('foo', 'users', ['user1', 'user2']) == \
+        ['user1', 'user2']
+    assert yolodb.add_value('foo', 'users', ['user1', 'user3']) == \
+        ['user1', 'user2', 'user3']
+    assert yolodb.add_value('bar', 'users', ['user1']) is None
+
+
+def test_set_value_should_replace_the_field(yolodb):
+    yolodb.add_site('foo')
+    yolodb.add_value('foo', 'users', ['user1'])
+    result = yolodb.set_value('foo', 'users', ['user2'])
+    assert result['replaced'] == 1
+    assert result['changes'][0]['new_val']['users'] == ['user2']
+
+    yolodb.set_value('foo', 'speed', ['100'])
+    assert yolodb.get_site('foo')['speed'] == 100
+    assert yolodb.set_value('bar', 'speed', ['100'])['skipped'] == 1
+
+
+def test_set_value_should_validate_the_field(yolodb):
+    yolodb.add_site('foo')
+    with pytest.raises(yolodb.InvalidField):
+        yolodb.set_value('foo', 'nope', ['1'])
+    with pytest.raises(yolodb.InvalidType):
+        yolodb.set_value('foo', 'speed', ['fast'])
+
+
+def test_remove_value_should_remove_from_a_list(yolodb):
+    yolodb.add_site('foo')
+    yolodb.add_value('foo', 'users', ['user1', 'user2'])
+    result = yolodb.remove_value('foo', 'users', ['user1', 'user3'])
+    assert result['errors'] == 0
+    assert yolodb.get_site('foo')['users'] == ['user2']
+    assert yolodb.remove_value('bar', 'users', ['user1'])['skipped'] == 1
+
+
+def test_removing_a_non_list_value_should_no_op(yolodb):
+    yolodb.add_site('foo')
+    yolodb.set_value('foo', 'comment', ['this is a comment'])
+    result = yolodb.remove_value('foo', 'comment', ['this is a comment'])
+    assert result['unchanged'] == 1
+    assert yolodb.get_site('foo')['comment'] == 'this is a comment'
+
+
+def test_delete_site_should_delete_its_values_too(yolodb):
+    yolodb.add_site('foo')
+    yolodb.add_value('foo', 'users', ['user1'])
+    assert yolodb.delete_site('foo')['deleted'] == 1
+    assert yolodb.delete_site('foo')['deleted'] == 0
+
+    yolodb.add_site('foo')
+    assert yolodb.get_site('foo')['users'] == []
+
+
+def test_list_sites_should_be_sorted_and_paginated(yolodb):
+    for site in ['foo', 'bar', 'baz', 'alpha']:
+        yolodb.add_site(site)
+
+    assert names(yolodb.list_sites()) == ['ALPHA', 'BAR', 'BAZ', 'FOO']
+    assert names(yolodb.list_sites(2, 3)) == ['FOO']
+
+
+def test_list_sites_should_stream_in_batches(yolodb, monkeypatch):
+    monkeypatch.setattr(sqlite_db, 'BATCH_SIZE', 2)
+    for i in range(5):
+        yolodb.add_site('site{}'.format(i))
+    assert len(list(yolodb.list_sites())) == 5
+
+
+def test_search_should_work(yolodb):
+    for site in ['foo', 'bar', 'baz']:
+        yolodb.add_site(site)
+    yolodb.set_value('foo', 'users', ['user1', 'user2'])
+    yolodb.set_value('bar', 'users', ['user1'])
+    yolodb.set_value('baz', 'affils', ['GRP1'])
+    yolodb.set_value('baz', 'speed', ['100'])
+
+    assert names(yolodb.search('users', 'user1')) == ['BAR', 'FOO']
+    assert names(yolodb.search('users', 'user*')) == ['BAR', 'FOO']
+    assert names(yolodb.search('users', 'user1', 2, 1)) == ['FOO']
+    assert names(yolodb.search('all', 'grp*')) == ['BAZ']
+    assert names(yolodb.search('speed', '100')) == ['BAZ']
+    assert list(yolodb.search('users', 'nobody')) == []
+
+
+def test_pattern_search_should_only_treat_star_as_a_wildcard(yolodb):
+    yolodb.add_site('foo')
+    yolodb.set_value('foo', 'users', ['a?c', 'abc'])
+    assert len(list(yolodb.search('users', 'a?c'))) == 1
+    assert len(list(yolodb.search('users', 'a?*'))) == 1
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks the cipher, the formatter, message dispatch and the database.
+
+Every benchmark is run for a few rounds and reported as operations per
+second and time per operation. Results can be saved as a baseline and later
+runs compared against it, any benchmark that got slower than the threshold
+is flagged and makes the run exit with status 1.
+
+Without --db-host the database benchmarks run against the in-memory site
+cache, so no server is needed.
+
+Run it from the yolobot directory:
+
+    python -m tools.bench --save=baseline.json
+    python -m tools.bench --compare=baseline.json -k 'fish_*'
+
+Usage:
+    bench.py [options]
+
+Options:
+    -k --filter=<pattern>  Only run the benchmarks matching this pattern, *
+                           matches anything
+    -t --min-time=<s>      Seconds to spend on each benchmark [default: 1]
+    -r --rounds=<n>        How many rounds to split that time in [default: 5]
+    -e --engine=<engine>   The fish engine to use [default: auto]
+    --db-host=<host>       Benchmark YoloDB against the RethinkDB server on
+                           this host, using a scratch database
+    --save=<path>          Save the results as a baseline
+    --compare=<path>       Compare the results with a saved baseline
+    --threshold=<percent>  How much slower than the baseline a benchmark can
+                           get before it's a regression [default: 10]
+"""
+import fnmatch
+import json
+import platform
+import sys
+import timeit
+
+import docopt
+import rethinkdb as r
+import trollius as asyncio
+
+import db
+import site_cache
+import yolobot_plugin
+import yolofish
+
+BENCH_DB = 'yolobot_bench'
+FISH_KEY = 'bench_fish_key'
+CHANNEL = '#bench'
+MESSAGE_SIZES = (16, 64, 300, 1000)
+
+
+def make_site(name, list_size=10, number=0):
+    """Builds a site document. Sites with nearby numbers share some of their
+    affils and users, like real sites do."""
+    return {
+        'name': name,
+        'country': 'SE',
+        'speed': 1000,
+        'affils': [
+            'GRP{}'.format((number + i) % 500) for i in range(list_size)
+        ],
+        'users': [
+            'user{}'.format((number * 3 + i) % 5000) for i in range(list_size)
+        ],
+        'allows': ['ALLOW{}'.format(i) for i in range(list_size)],
+        'comment': 'a site used for benchmarks',
+    }
+
+
+def make_sites(count, list_size=10):
+    return [
+        make_site('SITE{:05}'.format(i), list_size, i) for i in range(count)
+    ]
+
+
+class CachedYoloDB(db.YoloDB):
+    """A YoloDB that answers every read from a preloaded site cache, and
+    never talks to a server"""
+    def __init__(self, sites):
+        self.host = self.db_name = self.snapshot_path = None
+        self.pool = db.ConnectionPool(None, None)
+        self.indexes = set()
+        self.cache = site_cache.SiteCache(self)
+        self.cache.reload(sites)
+
+
+class FakeBot(object):
+    def __init__(self, engine):
+        self.loop = asyncio.new_event_loop()
+        self.config = {
+            'fish_key': FISH_KEY,
+            'fish_engine': engine,
+            'flood_rate': 1e9,
+            'flood_burst': 1e9,
+            'repeat_window': 0,
+        }
+        self.sent = 0
+        self.tasks = []
+
+    def privmsg(self, target, message):
+        self.sent += 1
+
+    def create_task(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+    def run_pending(self):
+        """Runs the command tasks to the end, and then whatever else is
+        scheduled, e.g. the outbox sending the replies"""
+        tasks, self.tasks = self.tasks, []
+        if tasks:
+            self.loop.run_until_complete(asyncio.wait(tasks, loop=self.loop))
+        self.loop.stop()
+        self.loop.run_forever()
+
+
+class BenchPlugin(yolobot_plugin.Plugin):
+    @staticmethod
+    def create_db(config):
+        return CachedYoloDB(make_sites(100))
+
+
+def bench_fish(engine):
+    fish = yolofish.YoloFish(FISH_KEY, engine)
+    benchmarks = []
+    for size in MESSAGE_SIZES:
+        plaintext = ('x' * 7 + ' ') * (size // 8) + 'x' * (size % 8)
+        cipher_texts = [
+            message[4:-1] for message in fish.encrypt_many([plaintext])
+        ]
+        benchmarks.append(
+            ('fish_encrypt_{}'.format(size),
+             lambda plaintext=plaintext: fish.encrypt(plaintext))
+        )
+        benchmarks.append(
+            ('fish_decrypt_{}'.format(size),
+             lambda cipher_texts=cipher_texts: fish.decrypt_many(cipher_texts))
+        )
+
+    lines = ['x' * 60] * 10
+    benchmarks.append(
+        ('fish_encrypt_many_10', lambda: fish.encrypt_many(lines))
+    )
+    return benchmarks
+
+
+def bench_formatter():
+    formatter = yolobot_plugin.Formatter()
+    small, large = make_site('SMALL'), make_site('LARGE', 500)
+    return [
+        ('format_site', lambda: formatter.format_site(small)),
+        ('format_site_500', lambda: formatter.format_site(large)),
+    ]
+
+
+def bench_dispatch(engine):
+    bot = FakeBot(engine)
+    plugin = BenchPlugin(bot)
+    fish = yolofish.YoloFish(FISH_KEY, engine)
+    chat = fish.encrypt('did anyone see the new release on that site?')
+    command = fish.encrypt('!help')
+    site_command = fish.encrypt('!site SITE00001')
+    mask = 'someone!user@host'
+    site = make_site('SITE00001')
+
+    def dispatch(message):
+        plugin.on_message(mask, 'PRIVMSG', CHANNEL, message)
+        bot.run_pending()
+
+    def send_site():
+        # after the first call this is a hit in the reply cache
+        plugin.send_site(CHANNEL, site)
+        bot.run_pending()
+
+    return [
+        ('dispatch_chat', lambda: dispatch(chat)),
+        ('dispatch_command', lambda: dispatch(command)),
+        # runs on the loop and reads through the executor
+        ('dispatch_site_command', lambda: dispatch(site_command)),
+        ('send_site_cached', send_site),
+    ]
+
+
+def bench_cached_db():
+    yolodb = CachedYoloDB(make_sites(10000))
+    return [
+        ('db_cache_get_site', lambda: yolodb.get_site('SITE00042')),
+        ('db_cache_search', lambda: list(yolodb.search('users', 'user3'))),
+        ('db_cache_search_pattern',
+         lambda: list(yolodb.search('affils', 'GRP1*'))),
+        ('db_cache_list_sites_page',
+         lambda: list(yolodb.list_sites(50, 100))),
+    ]
+
+
+def bench_db(host):
+    yolodb = db.YoloDB(host, BENCH_DB)
+    sites = make_sites(1000)
+    with yolodb.connection() as conn:
+        r.table(yolodb.SITES_TABLE_NAME).insert(sites).run(conn)
+
+    counter = [0]
+
+    def add_and_delete():
+        counter[0] += 1
+        name = 'NEW{}'.format(counter[0])
+        yolodb.add_site(name)
+        yolodb.delete_site(name)
+
+    return [
+        ('db_get_site', lambda: yolodb.get_site('SITE00042')),
+        ('db_set_value',
+         lambda: yolodb.set_value('SITE00042', 'comment', ['bench'])),
+        ('db_add_value',
+         lambda: yolodb.add_value('SITE00042', 'users', ['x'])),
+        ('db_add_delete_site', add_and_delete),
+        ('db_search_index', lambda: list(yolodb.search('users', 'user3'))),
+        ('db_search_pattern', lambda: list(yolodb.search('affils', 'GRP1*'))),
+        ('db_list_sites_page', lambda: list(yolodb.list_sites(5, 100))),
+    ], yolodb
+
+
+def measure(func, min_time, rounds):
+    """Runs `func` for about `min_time` seconds, split in `rounds` rounds.
+
+    :return: The time per call of every round, in seconds
+    """
+    timer = timeit.Timer(func)
+    round_time = min_time / rounds
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= round_time / 10:
+            break
+        number *= 10
+    number = max(1, int(number * round_time / elapsed))
+    return [timer.timeit(number) / number for _ in range(rounds)], number
+
+
+def summarize(per_call, number):
+    per_call = sorted(per_call)
+    median = per_call[len(per_call) // 2]
+    return {
+        'median': median,
+        'min': per_call[0],
+        'ops_per_sec': 1 / median if median else float('inf'),
+        'number': number,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Yields (name, change in percent, regressed) for every benchmark that
+    is in both"""
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = (result['median'] / before['median'] - 1) * 100
+        yield name, change, change > threshold
+
+
+def main(argv=None):
+    args = docopt.docopt(__doc__, argv=argv)
+    min_time = float(args['--min-time'])
+    rounds = int(args['--rounds'])
+    threshold = float(args['--threshold'])
+    engine = args['--engine']
+
+    benchmarks = bench_fish(engine) + bench_formatter() + \
+        bench_dispatch(engine) + bench_cached_db()
+    yolodb = None
+    if args['--db-host']:
+        db_benchmarks, yolodb = bench_db(args['--db-host'])
+        benchmarks += db_benchmarks
+    if args['--filter']:
+        benchmarks = [
+            (name, func) for name, func in benchmarks
+            if fnmatch.fnmatch(name, args['--filter'])
+        ]
+
+    results = {}
+    try:
+        for name, func in benchmarks:
+            results[name] = summarize(*measure(func, min_time, rounds))
+            sys.stdout.write(
+                '{:<28} {:>12,.0f} ops/s {:>12.2f} us/op '
+                '(min {:.2f})\n'.format(
+                    name,
+                    results[name]['ops_per_sec'],
+                    results[name]['median'] * 1e6,
+                    results[name]['min'] * 1e6,
+                )
+            )
+    finally:
+        if yolodb is not None:
+            with yolodb.connection() as conn:
+                r.db_drop(BENCH_DB).run(conn)
+            yolodb.close()
+
+    if args['--save']:
+        with open(args['--save'], 'w') as baseline_file:
+            json.dump({
+                'python': platform.python_version(),
+                'engine': engine,
+                'results': results,
+            }, baseline_file, indent=2, sort_keys=True)
+
+    regressions = 0
+    if args['--compare']:
+        with open(args['--compare']) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        sys.stdout.write('\ncompared with {}:\n'.format(args['--compare']))
+        for name, change, regressed in compare(results, baseline, threshold):
+            sys.stdout.write('{:<28} {:>+8.1f}%{}\n'.format(
+                name, change, '  REGRESSION' if regressed else ''
+            ))
+            regressions += regressed
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
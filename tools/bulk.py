@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""Streams sites in and out of the sites table.
+
+Sites are read and written one at a time, so memory use doesn't grow with the
+size of the table. Imports are validated against sitebot_config and inserted
+in batches. Only the rethinkdb db_backend is supported.
+
+Run it from the yolobot directory:
+
+    python -m tools.bulk export sites.jsonl.gz
+    python -m tools.bulk import --conflict=replace sites.csv
+
+Usage:
+    bulk.py export [options] <file>
+    bulk.py import [options] <file>
+
+Arguments:
+    <file>                 The file to read or write, - for stdin/stdout
+
+Options:
+    -c --config=<path>     Read db_backend, db_host and db_name from the [bot]
+                           section of this file [default: config.ini]
+    -f --format=<format>   jsonl or csv, guessed from the file name otherwise
+    -z --gzip              Compress the export, implied by a .gz file name.
+                           Imports of .gz files are decompressed
+    -b --batch-size=<n>    How many sites to insert per query [default: 500]
+    --conflict=<mode>      What to do with sites that already exist: error,
+                           replace or update [default: update]
+"""
+import csv
+import gzip
+import json
+import sys
+
+import configparser
+import docopt
+import rethinkdb as r
+
+import db
+import sitebot_config
+import yolo_utils
+
+FORMATS = ('jsonl', 'csv')
+CONFLICT_MODES = ('error', 'replace', 'update')
+
+# name first, then the rest in alphabetical order
+CSV_COLUMNS = [db.YoloDB.PRIMARY_KEY] + sorted(
+    field for field in sitebot_config.COLUMN_MAPPING
+    if field != db.YoloDB.PRIMARY_KEY
+)
+
+
+class InvalidRecord(Exception):
+    pass
+
+
+def guess_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+
+def open_file(path, mode, compress):
+    if path == '-':
+        stream = sys.stdout if 'w' in mode else sys.stdin
+        if compress:
+            return gzip.GzipFile(fileobj=stream, mode=mode)
+        return stream
+    if compress or path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def to_site(yolodb, record):
+    """Validates a record read from a file and casts it into a site document,
+    the same way the !set and !add commands would.
+
+    :param yolodb: Used for YoloDB.validate_field
+    :param record: Maps field names to values. List fields can be lists or
+    space separated strings.
+    """
+    site = {}
+    for field, value in record.items():
+        if value is None or value == '' or value == []:
+            continue
+
+        field_type = sitebot_config.COLUMN_MAPPING.get(field)
+        if field_type is None:
+            raise InvalidRecord('invalid field {}'.format(field))
+
+        if field_type == list:
+            if isinstance(value, basestring):
+                values = value.split()
+            elif isinstance(value, list):
+                values = [unicode(each) for each in value]
+            else:
+                raise InvalidRecord('field {} must be a list'.format(field))
+        else:
+            values = [unicode(value)]
+        values = yolo_utils.uppercase_if_needed(field, values)
+
+        try:
+            site[field] = yolodb.validate_field(field, values)
+        except yolodb.InvalidType as exc:
+            raise InvalidRecord(
+                'field {} must be of type: {}'.format(field, exc)
+            )
+
+    if not site.get(db.YoloDB.PRIMARY_KEY):
+        raise InvalidRecord('missing site name')
+    site[db.YoloDB.PRIMARY_KEY] = site[db.YoloDB.PRIMARY_KEY].upper()
+    return site
+
+
+def read_records(stream, file_format):
+    """Yields (line number, record) for every record in the file. JSON
+    lines are yielded as they were read and parsed by load_record, so a bad
+    line doesn't end the import."""
+    if file_format == 'csv':
+        for line_number, row in enumerate(csv.DictReader(stream), 2):
+            yield line_number, {
+                field: (value or '').decode('utf-8')
+                for field, value in row.items()
+                if field is not None
+            }
+    else:
+        for line_number, line in enumerate(stream, 1):
+            if line.strip():
+                yield line_number, line
+
+
+def load_record(record):
+    """Parses a record yielded by read_records, raises ValueError if it
+    isn't valid JSON"""
+    if isinstance(record, basestring):
+        record = json.loads(record)
+    if not isinstance(record, dict):
+        raise InvalidRecord('not a JSON object')
+    return record
+
+
+def import_sites(yolodb, stream, file_format, batch_size, conflict):
+    """Inserts the sites read from `stream`. The totals count what the
+    database did with them ('errors' are the inserts it refused), and the
+    records that were never sent: 'invalid' ones that couldn't be parsed and
+    'skipped' ones that aren't valid sites."""
+    totals = {'inserted': 0, 'replaced': 0, 'unchanged': 0, 'errors': 0}
+
+    def flush(batch):
+        with yolodb.connection() as conn:
+            result = r.table(yolodb.SITES_TABLE_NAME).insert(
+                batch, conflict=conflict
+            ).run(conn)
+        for key in totals:
+            totals[key] += result.get(key, 0)
+        if result.get('first_error'):
+            sys.stderr.write('{}\n'.format(result['first_error']))
+
+    batch, skipped, invalid = [], 0, 0
+    for line_number, record in read_records(stream, file_format):
+        try:
+            batch.append(to_site(yolodb, load_record(record)))
+        except (InvalidRecord, yolodb.InvalidField) as exc:
+            skipped += 1
+            sys.stderr.write('line {}: {}\n'.format(line_number, exc))
+            continue
+        except (ValueError, TypeError) as exc:
+            invalid += 1
+            sys.stderr.write('line {}: {}\n'.format(line_number, exc))
+            continue
+
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    totals['skipped'] = skipped
+    totals['invalid'] = invalid
+    return totals
+
+
+def export_sites(yolodb, stream, file_format):
+    count = 0
+    if file_format == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(CSV_COLUMNS)
+
+    with yolodb.connection() as conn:
+        # ordering by the primary index keeps the result a stream
+        cursor = r.table(yolodb.SITES_TABLE_NAME).order_by(
+            index=yolodb.PRIMARY_KEY
+        ).run(conn)
+        for site in cursor:
+            if file_format == 'csv':
+                writer.writerow([
+                    unicode_value(site.get(field)).encode('utf-8')
+                    for field in CSV_COLUMNS
+                ])
+            else:
+                stream.write(json.dumps(site, sort_keys=True))
+                stream.write('\n')
+            count += 1
+
+    return {'exported': count}
+
+
+def unicode_value(value):
+    if value is None:
+        return u''
+    if isinstance(value, list):
+        return u' '.join(value)
+    return unicode(value)
+
+
+def main(argv=None):
+    args = docopt.docopt(__doc__, argv=argv)
+
+    file_format = args['--format'] or guess_format(args['<file>'])
+    if file_format not in FORMATS:
+        sys.exit('Unknown format: {}'.format(file_format))
+    if args['--conflict'] not in CONFLICT_MODES:
+        sys.exit('Unknown conflict mode: {}'.format(args['--conflict']))
+
+    config = configparser.ConfigParser()
+    config.read(args['--config'])
+    backend = config['bot'].get('db_backend', 'rethinkdb')
+    if backend != 'rethinkdb':
+        sys.exit(
+            'Only the rethinkdb backend can be imported into or exported '
+            'from, db_backend is {}'.format(backend)
+        )
+    yolodb = db.YoloDB(config['bot']['db_host'], config['bot']['db_name'])
+
+    try:
+        if args['export']:
+            stream = open_file(args['<file>'], 'wb', args['--gzip'])
+            try:
+                totals = export_sites(yolodb, stream, file_format)
+            finally:
+                if stream is not sys.stdout:
+                    stream.close()
+        else:
+            stream = open_file(args['<file>'], 'rb', False)
+            try:
+                totals = import_sites(
+                    yolodb,
+                    stream,
+                    file_format,
+                    int(args['--batch-size']),
+                    args['--conflict']
+                )
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+    finally:
+        yolodb.close()
+
+    sys.stderr.write(
+        ' '.join(
+            '{}: {}'.format(key, value)
+            for key, value in sorted(totals.items())
+        ) + '\n'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import string
-import sitebot_config
+
+import schema
 
 
 def uppercase_if_needed(field, values):
@@ -14,7 +15,7 @@ def uppercase_if_needed(field, values):
     :return: The values either in uppercase or untouched
     :rtype: list
     """
-    if field in sitebot_config.ALWAYS_UPPERCASE:
+    if field in schema.SCHEMA.uppercase:
         if isinstance(values, list):
             return map(string.upper, values)
         return values.upper()
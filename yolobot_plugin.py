@@ -1,53 +1,131 @@
 # -*- coding: utf-8 -*-
+import copy
+import fnmatch
 import string
+import sys
 
 import irc3
+import trollius as asyncio
+from trollius import From
 
 import db
+import hot_reload
+import metrics
+import outbound
+import reply_cache
+import schema
+import site_cache
+import site_index
 import sitebot_config
+import snapshot
+import sqlite_db
+import storage
 import yolo_utils
 import yolofish
 
 BOLD = '\x02'
 
+# the modules !reload reloads if their source changed, every module comes
+# after the modules it imports
+RELOAD_MODULES = (
+    sitebot_config,
+    schema,
+    yolo_utils,
+    yolofish,
+    site_index,
+    storage,
+    site_cache,
+    snapshot,
+    sqlite_db,
+    db,
+    outbound,
+    reply_cache,
+)
+hot_reload.track(sys.modules[__name__], *RELOAD_MODULES)
+
+metrics.REGISTRY.describe(
+    'command', 'command', 'Time taken by commands, until the reply is queued'
+)
+COMMAND_PREFIX = '!'
+
+# Decrypted messages are stripped of everything that isn't in
+# string.printable, with a single str.translate
+UNPRINTABLE = ''.join(
+    chr(i) for i in range(256) if chr(i) not in string.printable
+)
+
+
+def decrypt_command(fish, cipher_text):
+    """Decrypts a message if it is a command, and returns None if it isn't.
+
+    Most channel traffic is chat, so only the first cipher block is decrypted
+    to look for the command prefix. The rest is only decrypted for commands.
+
+    :param fish: The YoloFish for the channel
+    :param cipher_text: The message without its '+OK ' prefix
+    :return: The printable part of the decrypted message, or None
+    """
+    first_block = fish.decrypt(cipher_text[:yolofish.ENCODED_BLOCK_SIZE])
+    first_block = first_block.translate(None, UNPRINTABLE).lstrip()
+    if first_block and not first_block.startswith(COMMAND_PREFIX):
+        return None
+    if len(cipher_text) <= yolofish.ENCODED_BLOCK_SIZE:
+        msg = first_block
+    else:
+        msg = fish.decrypt(cipher_text).translate(None, UNPRINTABLE)
+    return msg if msg.lstrip().startswith(COMMAND_PREFIX) else None
+
+
+def _format_list(value):
+    return ' '.join(sorted(value)) if value else ''
+
+
+def _format_scalar(value):
+    return value if value is not None else ''
+
 
 class Formatter(object):
+    """Renders sites the way sitebot_config.LAYOUT says.
+
+    The layout is compiled once into a render plan: for every cell of every
+    row, the bold label, the column to read and the function that turns its
+    value into text. Formatting a site is then a single pass over the plan.
+    """
+    def __init__(self, layout=None, fields=None):
+        """
+        :param layout: Defaults to sitebot_config.LAYOUT
+        :param fields: Defaults to sitebot_config.FIELDS
+        """
+        layout = sitebot_config.LAYOUT if layout is None else layout
+        fields = sitebot_config.FIELDS if fields is None else fields
+        self.plan = tuple(
+            tuple(
+                (
+                    '{}: '.format(self.bold(field)),
+                    fields[field]['column_name'],
+                    _format_list if fields[field]['type'] is list
+                    else _format_scalar
+                )
+                for field in row
+            )
+            for row in layout
+        )
+
     @classmethod
     def bold(cls, text):
         return '{}{}{}'.format(BOLD, text, BOLD)
 
-    @classmethod
-    def format_site(cls, site_info):
+    def format_site(self, site_info):
         """Formats the site info into the format specified in the
-        sitebot_config"""
-        output = []
-        for row in sitebot_config.LAYOUT:
-            line_output = []
-            for field in row:
-                if sitebot_config.FIELDS[field]['type'] is list:
-                    field_value = site_info.get(
-                        sitebot_config.FIELDS[field]['column_name'],
-                        []
-                    )
-                    if len(field_value) > 0:
-                        field_value.sort()
-                        field_value = ' '.join(field_value)
-                    else:
-                        field_value = ''
-                else:
-                    field_value = site_info.get(
-                        sitebot_config.FIELDS[field]['column_name'],
-                        ''
-                    )
-
-                line_output.append(
-                    '{}: {}'.format(
-                        cls.bold(field),
-                        field_value
-                    )
-                )
-            output.append(' '.join(line_output))
-        return output
+        sitebot_config. The site itself is left untouched."""
+        get = site_info.get
+        return [
+            ' '.join(
+                '{}{}'.format(label, render(get(column)))
+                for label, column, render in row
+            )
+            for row in self.plan
+        ]
 
 
 @irc3.plugin
@@ -62,18 +140,157 @@ class Plugin(object):
         '!set',
         '!site',
         '!sites',
+        '!stats',
     )
 
-    # max length of a message we will send at once before breaking into chunks
-    MAX_MSG_LENGTH = 490
-
-    def __init__(self, bot):
+    # commands only the hostmasks in the admins option can run
+    ADMIN_COMMANDS = frozenset(['!stats'])
+
+    # identical read commands from the same channel are only run once while
+    # one of them is still running
+    READ_COMMANDS = frozenset(['!search', '!site', '!sites'])
+
+    # max length of an encrypted message, longer replies are split. None
+    # sends as much as fits in the IRC line to the channel, once the server
+    # added the relay prefix. The max_msg_length option overrides it.
+    MAX_MSG_LENGTH = None
+
+    # how many results are fetched from the database per round trip while
+    # streaming !sites and !search output
+    STREAM_CHUNK_SIZE = 50
+
+    # the state !reload hands over to the new plugin, with the modules and
+    # options it is built from. It's only built again if one of them changed.
+    RELOAD_STATE = {
+        'keyring': (
+            ('yolofish',),
+            ('fish_key', 'fish_keys', 'fish_max_contexts', 'fish_engine'),
+        ),
+        'outbox': (
+            ('outbound',),
+            (
+                'flood_rate',
+                'flood_burst',
+                'max_msg_length',
+                'relay_prefix_length',
+            ),
+        ),
+        'db': (
+            ('db',),
+            (
+                'db_backend',
+                'sqlite_path',
+                'db_host',
+                'db_name',
+                'db_pool_size',
+                'db_idle_timeout',
+                'db_workers',
+                'site_cache',
+                'snapshot_path',
+            ),
+        ),
+        # cached replies are formatted here and encrypted by yolofish
+        'replies': (
+            (__name__, 'reply_cache', 'yolofish'), ('reply_cache_size',)
+        ),
+    }
+
+    def __init__(self, bot, state=None):
+        """
+        :param state: What the plugin being reloaded handed over, see
+        RELOAD_STATE. Everything missing is built from scratch.
+        """
+        state = state or {}
         self.validate_layout()
+        self.formatter = Formatter()
+        # command -> the method that handles it. Coroutines are timed by
+        # timed_command instead, once they have run.
+        self.commands = {}
+        for command in self.COMMANDS:
+            handler = getattr(self, command.lstrip(COMMAND_PREFIX))
+            if not asyncio.iscoroutinefunction(handler):
+                handler = metrics.timed('command', command)(handler)
+            self.commands[command] = handler
 
         self.bot = bot
-        self.fish = yolofish.YoloFish(bot.config['fish_key'])
+        self.settings = self.current_settings(bot.config)
+        if 'keyring' in state:
+            self.keyring = state['keyring']
+        else:
+            self.keyring = yolofish.FishKeyring(
+                bot.config.get('fish_key'),
+                bot.config.get('fish_keys', {}),
+                int(bot.config.get('fish_max_contexts', 32)),
+                bot.config.get('fish_engine', 'auto')
+            )
+        if 'outbox' in state:
+            self.outbox = state['outbox']
+            self.outbox.keyring = self.keyring
+        else:
+            self.outbox = outbound.OutboundQueue(
+                bot.privmsg,
+                self.keyring,
+                bot.loop,
+                float(bot.config.get('flood_rate', 0.5)),
+                int(bot.config.get('flood_burst', 5)),
+                int(bot.config.get('max_msg_length') or 0) or
+                self.MAX_MSG_LENGTH,
+                relay_prefix_length=int(bot.config.get(
+                    'relay_prefix_length', yolofish.RELAY_PREFIX_LENGTH
+                ))
+            )
 
-        self.db = db.YoloDB(bot.config['db_host'], bot.config['db_name'])
+        if 'db' in state:
+            self.db = state['db']
+        else:
+            self.db = db.AsyncYoloDB(
+                self.create_db(bot.config),
+                bot.loop,
+                int(bot.config.get('db_workers', 4))
+            )
+        if 'replies' in state:
+            self.replies = state['replies']
+        else:
+            self.replies = reply_cache.ReplyCache(
+                int(bot.config.get('reply_cache_size', 256))
+            )
+        # read commands that are still running, and when recent ones finished
+        self.in_flight = state.get('in_flight', {})
+        self.recent = state.get('recent', {})
+        # seconds during which a repeated read command is ignored, 0 only
+        # ignores it while the first one is still running
+        self.repeat_window = float(bot.config.get('repeat_window', 0))
+        self.command_stats = state.get(
+            'command_stats', {'coalesced': 0, 'suppressed': 0}
+        )
+        # how many sites !sites <page> and !search ... <page> show
+        self.page_size = int(bot.config.get('page_size', 100))
+
+        self.admins = [
+            admin.lower() for admin in bot.config.get('admins', '').split()
+        ]
+        self.register_stats()
+        self.metrics_file = bot.config.get('metrics_file')
+        self.metrics_interval = float(bot.config.get('metrics_interval', 60))
+        self._metrics_handle = None
+        if self.metrics_file:
+            self._metrics_handle = bot.loop.call_later(
+                self.metrics_interval, self.write_metrics
+            )
+
+    @classmethod
+    def current_settings(cls, config):
+        """The options the state in RELOAD_STATE is built from"""
+        return copy.deepcopy({
+            option: config.get(option)
+            for _, options in cls.RELOAD_STATE.values()
+            for option in options
+        })
+
+    @staticmethod
+    def create_db(config):
+        """Builds the storage backend the commands run against"""
+        return db.create_db(config)
 
     @staticmethod
     def validate_layout():
@@ -113,10 +330,15 @@ class Plugin(object):
         # We only care about messages from channels
         if target.startswith('#'):
             if data.startswith('+OK ') or data.startswith('mcps '):
+                fish = self.keyring.get(target)
+                if fish is None:
+                    return
+
                 data = data.strip()
                 _, msg = data.split(' ', 1)
-                msg = self.fish.decrypt(msg)
-                msg = ''.join(_ for _ in msg if _ in string.printable)
+                msg = decrypt_command(fish, msg)
+                if msg is None:
+                    return
                 parts = msg.split()
 
                 if parts[0] == '!reload':
@@ -126,8 +348,85 @@ class Plugin(object):
                         'Reloaded!'
                     )
 
-                if parts[0] in self.COMMANDS:
-                    getattr(self, parts[0].lstrip('!'))(target, parts)
+                handler = self.commands.get(parts[0])
+                if handler is not None:
+                    if parts[0] in self.ADMIN_COMMANDS and \
+                            not self.is_admin(mask):
+                        return
+
+                    key = (target, tuple(parts))
+                    if parts[0] in self.READ_COMMANDS and \
+                            self.is_repeat(key):
+                        return
+
+                    result = handler(target, parts)
+                    if asyncio.iscoroutine(result):
+                        # database commands run as tasks so a slow query
+                        # doesn't hold up everything else
+                        task = self.bot.create_task(
+                            self.timed_command(parts[0], result)
+                        )
+                        if parts[0] in self.READ_COMMANDS:
+                            self.track(key, task)
+
+    @staticmethod
+    @asyncio.coroutine
+    def timed_command(command, coroutine):
+        """Runs a command's coroutine, recording how long it took in the
+        command metrics"""
+        start = metrics.now()
+        try:
+            yield From(coroutine)
+        except Exception:
+            metrics.REGISTRY.observe(
+                'command', command, metrics.now() - start, True
+            )
+            raise
+        metrics.REGISTRY.observe('command', command, metrics.now() - start)
+
+    def is_admin(self, mask):
+        mask = mask.lower()
+        return any(fnmatch.fnmatch(mask, admin) for admin in self.admins)
+
+    def is_repeat(self, key):
+        """Tells if the read command `key` is already running in the same
+        channel, or finished less than repeat_window seconds ago. Its reply
+        is on its way or was just sent, so there's no need to run it again.
+
+        :param key: (channel, command parts)
+        """
+        if key in self.in_flight:
+            self.command_stats['coalesced'] += 1
+            return True
+
+        finished = self.recent.get(key)
+        if finished is not None:
+            if self.bot.loop.time() - finished < self.repeat_window:
+                self.command_stats['suppressed'] += 1
+                return True
+            del self.recent[key]
+        return False
+
+    def track(self, key, task):
+        """Remembers a running read command until it is done, and then for
+        repeat_window seconds"""
+        self.in_flight[key] = task
+
+        def done(_):
+            del self.in_flight[key]
+            if self.repeat_window > 0:
+                now = self.bot.loop.time()
+                for old_key, finished in self.recent.items():
+                    if now - finished >= self.repeat_window:
+                        del self.recent[old_key]
+                self.recent[key] = now
+        task.add_done_callback(done)
+
+    def site_changed(self, site_name):
+        """Forgets everything that was sent about the site, after a write"""
+        self.replies.invalidate(site_name.upper())
+        # a repeated read could have a different answer now
+        self.recent.clear()
 
     def usage(self, args, target, num_args, usage_message):
         """Checks to see if the required number of arguments are provided. If
@@ -151,6 +450,59 @@ class Plugin(object):
             return True
         return False
 
+    def parse_page(self, args, position, target, usage_message):
+        """Reads the optional page number at `position` in `args`.
+
+        :return: The page number, None if there is none, or False if it isn't
+        a valid page number, in which case the usage was printed out
+        """
+        if len(args) <= position:
+            return None
+        if args[position].isdigit() and int(args[position]) > 0:
+            return int(args[position])
+
+        self.send_msg(
+            target,
+            '{} {}'.format(Formatter.bold('Usage:'), usage_message)
+        )
+        return False
+
+    @asyncio.coroutine
+    def stream_names(self, target, results, render):
+        """Sends the names of the sites in `results` to the channel as they
+        come in from the database, packing as many names on a line as fit.
+
+        :param results: An iterator from AsyncYoloDB.list_sites or search
+        :param render: Turns the space separated names into the line to send
+        :return: How many names were sent
+        """
+        budget = self.outbox.line_budget(target) - len(render(''))
+        line, line_length, count = [], 0, 0
+        try:
+            while True:
+                chunk = yield From(
+                    self.db.next_chunk(results, self.STREAM_CHUNK_SIZE)
+                )
+                if not chunk:
+                    break
+
+                for site in chunk:
+                    name = site['name']
+                    if line and line_length + 1 + len(name) > budget:
+                        self.send_msg(target, render(' '.join(line)))
+                        line, line_length = [], 0
+                    line_length += len(name) + (1 if line else 0)
+                    line.append(name)
+                    count += 1
+        finally:
+            # let go of the cursor and its connection if we stopped early
+            self.db.close_results(results)
+
+        if line:
+            self.send_msg(target, render(' '.join(line)))
+        raise asyncio.Return(count)
+
+    @asyncio.coroutine
     def add(self, target, args):
         if self.usage(args, target, 4, '!add <site> <field> <value(s)>'):
             return
@@ -159,14 +511,23 @@ class Plugin(object):
 
         values = yolo_utils.uppercase_if_needed(field, values)
 
-        if not sitebot_config.COLUMN_MAPPING.get(field) == list:
-            return self.send_msg(
+        if field not in schema.SCHEMA.list_fields:
+            self.send_msg(
                 target,
                 'Field {} only allows 1 value! Perhaps you want to !set '
                 'instead?'.format(args[2])
             )
+            return
+
+        result = yield From(self.db.add_value(site_name, field, values))
+        if result is None:
+            self.send_msg(
+                target,
+                'Site {} does not exist!'.format(Formatter.bold(site_name))
+            )
+            return
+        self.site_changed(site_name)
 
-        result = self.db.add_value(site_name, field, values)
         self.send_msg(
             target,
             '{}: set {} to: {}'.format(
@@ -176,24 +537,28 @@ class Plugin(object):
             )
         )
 
+    @asyncio.coroutine
     def addsite(self, target, args):
         """Attempts to add a site to the database"""
         if self.usage(args, target, 2, '!addsite <site>'):
             return
 
         try:
-            self.db.add_site(args[1])
+            yield From(self.db.add_site(args[1]))
         except self.db.AlreadyExistsError:
-            return self.send_msg(
+            self.send_msg(
                 target,
                 '{} is already added!'.format(Formatter.bold(args[1]))
             )
+            return
+        self.site_changed(args[1])
 
         self.send_msg(
             target,
             'Site {} has been added!'.format(Formatter.bold(args[1]))
         )
 
+    @asyncio.coroutine
     def rm(self, target, args):
         """Removes a value from a field"""
         if self.usage(args, target, 4, '!rm <site> <field> <value>'):
@@ -203,36 +568,44 @@ class Plugin(object):
         values = yolo_utils.uppercase_if_needed(field, values)
 
         try:
-            result = self.db.remove_value(site_name, field, values)
+            result = yield From(
+                self.db.remove_value(site_name, field, values)
+            )
         except self.db.InvalidField:
-            return self.send_msg(
+            self.send_msg(
                 target,
                 '{} is an invalid field! Use !set to see a list of valid '
                 'fields'.format(field)
             )
+            return
 
         if result['skipped'] > 0:
-            return self.send_msg(
+            self.send_msg(
                 target,
                 'Site {} does not exist!'.format(Formatter.bold(site_name))
             )
+            return
+        self.site_changed(site_name)
 
         self.send_msg(
             target,
             '{}: done!'.format(Formatter.bold(site_name))
         )
 
+    @asyncio.coroutine
     def delsite(self, target, args):
         """Deletes a site from the database"""
         if self.usage(args, target, 2, '!delsite <site>'):
             return
 
-        response = self.db.delete_site(args[1])
+        response = yield From(self.db.delete_site(args[1]))
         if response['deleted'] != 1:
-            return self.send_msg(
+            self.send_msg(
                 target,
                 'Site {} does not exist!'.format(args[1])
             )
+            return
+        self.site_changed(args[1])
 
         self.send_msg(
             target,
@@ -247,84 +620,99 @@ class Plugin(object):
             'Available commands: {}'.format(' '.join(self.COMMANDS))
         )
 
+    @asyncio.coroutine
     def search(self, target, args):
-        if self.usage(args, target, 3, '!search <field> <value>'):
+        usage_string = (
+            '!search <field|{}> <value, * matches anything> [page]'.format(
+                site_index.ALL_FIELDS
+            )
+        )
+        if self.usage(args, target, 3, usage_string):
+            return
+
+        page = self.parse_page(args, 3, target, usage_string)
+        if page is False:
             return
 
         field, values = args[1], args[2]
         values = yolo_utils.uppercase_if_needed(field, values)
 
-        if args[1] not in sitebot_config.VALID_FIELDS:
-            return self.send_msg(
+        if args[1] not in schema.SCHEMA.fields and \
+                args[1] != site_index.ALL_FIELDS:
+            self.send_msg(
                 target,
                 '{} is not a valid field!'.format(field)
             )
+            return
 
-        results = self.db.search(field, values)
-
-        if len(results) == 0:
-            return self.send_msg(
+        results = yield From(
+            self.db.search(field, values, page, self.page_size)
+        )
+        prefix = '{}: {} found on: '.format(Formatter.bold(field), values)
+        count = yield From(self.stream_names(
+            target,
+            results,
+            lambda names: prefix + Formatter.bold(names)
+        ))
+
+        if count == 0:
+            if page is not None and page > 1:
+                self.send_msg(target, 'No results on page {}!'.format(page))
+                return
+            self.send_msg(
                 target,
                 '{} was not found on any site!'.format(values)
             )
 
-        sorted_results = [each['name'] for each in results]
-        self.send_msg(
-            target,
-            '{}: {} found on: {}'.format(
-                Formatter.bold(field),
-                values,
-                Formatter.bold(' '.join(sorted_results))
-            )
-        )
-
     def send_msg(self, target, msg):
-        encrypted_msg = self.fish.encrypt(msg)
-        if isinstance(encrypted_msg, list):
-            for msg in encrypted_msg:
-                self.bot.privmsg(
-                    target,
-                    msg
-                )
-        else:
-            self.bot.privmsg(
-                target,
-                encrypted_msg
-            )
+        """Queues a message, the outbox encrypts it and sends it when the
+        flood limits allow"""
+        self.outbox.put(target, [msg])
 
+    def send_msgs(self, target, msgs):
+        """Queues several lines at once. Consecutive short lines are packed
+        into a single message."""
+        self.outbox.put(target, msgs)
+
+    @asyncio.coroutine
     def set(self, target, args):
         """Sets a value for a site"""
         usage_string = '!set <site> <field> <value(s)>'
         if self.usage(args, target, 4, usage_string):
-            valid_fields = sitebot_config.VALID_FIELDS
-            valid_fields.sort()
-            return self.send_msg(
+            self.send_msg(
                 target,
-                'Allowed fields: {}'.format(' '.join(valid_fields))
+                'Allowed fields: {}'.format(
+                    ' '.join(schema.SCHEMA.sorted_fields)
+                )
             )
+            return
 
         site_name, field, values = args[1], args[2], args[3:]
         values = yolo_utils.uppercase_if_needed(field, values)
 
         try:
-            result = self.db.set_value(site_name, field, values)
+            result = yield From(self.db.set_value(site_name, field, values))
         except self.db.InvalidField:
-            return self.send_msg(
+            self.send_msg(
                 target,
                 '{} is an invalid field! Use !set to see a list of valid '
                 'fields'.format(field)
             )
+            return
         except self.db.InvalidType as exc:
-            return self.send_msg(
+            self.send_msg(
                 target,
                 'Field {} must be of type: {}'.format(field, exc.message)
             )
+            return
 
         if result['skipped'] > 0:
-            return self.send_msg(
+            self.send_msg(
                 target,
                 'Site {} does not exist!'.format(site_name)
             )
+            return
+        self.site_changed(site_name)
 
         self.send_msg(
             target,
@@ -335,42 +723,180 @@ class Plugin(object):
             )
         )
 
+    @asyncio.coroutine
     def site(self, target, args):
         """Returns site info for the given site"""
         if self.usage(args, target, 2, '!site <site_name>'):
             return
 
-        site_info = self.db.get_site(args[1])
+        site_info = yield From(self.db.get_site(args[1]))
 
         if not site_info:
-            return self.send_msg(
+            self.send_msg(
                 target,
                 'Site {} does not exist!'.format(args[1])
             )
+            return
 
-        for line in Formatter.format_site(site_info):
-            self.send_msg(
-                target,
-                line
+        self.send_site(target, site_info)
+
+    def send_site(self, target, site_info):
+        """Sends the formatted site info. The encrypted lines are cached, so
+        sending the same revision of a site to a channel with the same key
+        again skips formatting and encryption."""
+        fish = self.keyring.get(target)
+        if fish is None:
+            return
+
+        name = site_info['name']
+        revision = reply_cache.site_revision(site_info)
+        # how the lines are packed depends on the length of the target too
+        key = (fish.key, self.outbox.line_budget(target))
+        messages = self.replies.get(name, revision, key)
+        if messages is None:
+            lines = self.outbox.pack(
+                target, self.formatter.format_site(site_info)
             )
+            messages = fish.encrypt_many(lines, key[1])
+            self.replies.put(name, revision, key, messages)
 
-    def sites(self, target, _):
-        """Returns a list of all sites in the database"""
-        results = self.db.list_sites()
-        if len(results) == 0:
-            return self.send_msg(
+        self.outbox.put_encrypted(target, messages)
+
+    @asyncio.coroutine
+    def sites(self, target, args):
+        """Returns a list of all sites in the database, or one page of it"""
+        page = self.parse_page(args, 1, target, '!sites [page]')
+        if page is False:
+            return
+
+        results = yield From(self.db.list_sites(page, self.page_size))
+        count = yield From(
+            self.stream_names(target, results, lambda names: names)
+        )
+
+        if count == 0:
+            if page is not None and page > 1:
+                self.send_msg(target, 'No sites on page {}!'.format(page))
+                return
+            self.send_msg(
                 target,
                 'No sites added yet! Add a site with !addsite.'
             )
 
-        self.send_msg(
-            target,
-            ' '.join([site['name'] for site in results])
+    def register_stats(self):
+        """Exports the stats of the queue, caches and database as gauges"""
+        registry = metrics.REGISTRY
+        registry.register_stats('commands', self.command_stats)
+        registry.register_stats('replies', self.replies.stats)
+        registry.register_stats('db', self.db.stats)
+        pool = getattr(self.db.db, 'pool', None)
+        if pool is not None:
+            registry.register_stats('pool', pool.stats)
+        outbox = self.outbox
+        registry.register_stats(
+            'outbox', lambda: dict(outbox.stats, depth=outbox.depth())
         )
+        cache = self.db.db.cache
+        if cache is not None:
+            registry.register_stats(
+                'cache', lambda: dict(cache.stats, staleness=cache.staleness())
+            )
+
+    def write_metrics(self):
+        """Writes the metrics file, and schedules the next write"""
+        try:
+            metrics.REGISTRY.write(self.metrics_file)
+        except (IOError, OSError):
+            self.bot.log.exception('Could not write %s', self.metrics_file)
+        self._metrics_handle = self.bot.loop.call_later(
+            self.metrics_interval, self.write_metrics
+        )
+
+    @staticmethod
+    def format_seconds(seconds):
+        return '{:.1f}ms'.format(seconds * 1000)
+
+    def stats(self, target, _):
+        """Shows the latency of commands, queries and the cipher, and how
+        the queue and caches are doing"""
+        lines = []
+        for family in ('command', 'db', 'fish'):
+            for label, count, errors, p50, p95, p99 in \
+                    metrics.REGISTRY.summary(family):
+                lines.append(
+                    '{} {}: {} calls, {} errors, p50 {} p95 {} p99 {}'.format(
+                        family,
+                        Formatter.bold(label),
+                        count,
+                        errors,
+                        self.format_seconds(p50),
+                        self.format_seconds(p95),
+                        self.format_seconds(p99),
+                    )
+                )
+
+        lines.append(
+            '{}: {} queued, {} sent, {} delayed, {} dropped'.format(
+                Formatter.bold('outbox'),
+                self.outbox.depth(),
+                self.outbox.stats['sent'],
+                self.outbox.stats['delayed'],
+                self.outbox.stats['dropped'],
+            )
+        )
+        lines.append(
+            '{}: {} hits, {} misses {}: {} coalesced, {} suppressed'.format(
+                Formatter.bold('replies'),
+                self.replies.stats['hits'],
+                self.replies.stats['misses'],
+                Formatter.bold('repeats'),
+                self.command_stats['coalesced'] + self.db.stats['coalesced'],
+                self.command_stats['suppressed'],
+            )
+        )
+        self.send_msgs(target, lines)
 
     @classmethod
     def reload(cls, old):
-        print 'reloading!'
-        reload(yolofish)
-        reload(db)
-        return cls(old.bot)
+        """Builds the plugin again once irc3 reloaded its module. The other
+        modules are only reloaded if their source changed, and the old
+        plugin's connections, caches, cipher contexts and queued lines are
+        handed over unless they are built from a module or an option that
+        changed."""
+        if old._metrics_handle is not None:
+            old._metrics_handle.cancel()
+        reloaded = hot_reload.reload_changed(
+            RELOAD_MODULES,
+            [__name__] if hot_reload.changed(sys.modules[__name__]) else []
+        )
+
+        settings = cls.current_settings(old.bot.config)
+        # plugins from before RELOAD_STATE have nothing to compare with
+        old_settings = getattr(old, 'settings', None)
+        state, stale = {}, []
+        for name, (modules, options) in sorted(cls.RELOAD_STATE.items()):
+            if old_settings is None or reloaded.intersection(modules) or any(
+                    settings[option] != old_settings.get(option)
+                    for option in options):
+                stale.append(name)
+            else:
+                state[name] = getattr(old, name)
+        state['in_flight'] = old.in_flight
+        state['recent'] = old.recent
+        state['command_stats'] = old.command_stats
+        old.bot.log.info(
+            'Reloading, reloaded modules: %s, rebuilt: %s',
+            ', '.join(sorted(reloaded)) or 'none',
+            ', '.join(stale) or 'nothing'
+        )
+
+        if 'db' in stale:
+            # closed first, so a snapshot written on close is the one the
+            # new backend starts from
+            old.db.close()
+        plugin = cls(old.bot, state)
+        if 'outbox' in stale:
+            # whatever the old outbox still has queued goes out against the
+            # same flood limits
+            plugin.outbox.take_over(old.outbox)
+        return plugin
@@ -1,59 +1,354 @@
 # -*- coding: utf-8 -*-
+import collections
 import ctypes
+import os
 
+import metrics
 
-class YoloFish(object):
+# libs/blowfish.so must exist in the root directory, i.e.
+# yolobot/libs/blowfish.so
+LIBRARY_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'libs', 'blowfish.so'
+)
+
+ENGINES = ('auto', 'c', 'numpy')
+
+metrics.REGISTRY.describe('fish', 'op', 'Time taken by the FiSH cipher')
+
+# an IRC line is at most 512 bytes, the \r\n at its end included
+IRC_LINE_LENGTH = 512
+PREFIX = '+OK '
+# every message is sent with this after the cipher text
+SUFFIX = '\x00'
+# every 8 byte block of plaintext is encrypted to 12 chars of base64
+BLOCK_SIZE = 8
+ENCODED_BLOCK_SIZE = 12
+# the server puts ":nick!user@host " in front of every message it relays to
+# the channel, and that has to fit in the 512 bytes too
+RELAY_PREFIX_LENGTH = 80
+
+
+def message_budget(target, relay_prefix_length=RELAY_PREFIX_LENGTH):
+    """The length of the longest message a PRIVMSG to `target` can carry
+
+    :param relay_prefix_length: How much of the line to leave for the
+    prefix the server adds when it relays the message
+    """
+    return IRC_LINE_LENGTH - relay_prefix_length - len(
+        'PRIVMSG {} :\r\n'.format(target)
+    )
+
+
+def plaintext_budget(max_length):
+    """The number of plaintext bytes that are sent as a single message of at
+    most `max_length` chars once encrypted"""
+    blocks = (max_length - len(PREFIX) - len(SUFFIX)) // ENCODED_BLOCK_SIZE
+    return blocks * BLOCK_SIZE
+
+
+# longer plaintext is split into several messages, this much fits in a
+# message to the shortest possible channel name
+MAX_PLAINTEXT_LENGTH = plaintext_budget(message_budget('#'))
+
+
+def encode(text):
+    """The UTF-8 bytes of `text`, the cipher works on bytes"""
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def utf8_boundary(data, limit):
+    """The largest index up to `limit` where `data` can be cut without
+    cutting a UTF-8 character in two, 0 if the first character is longer
+    than `limit`"""
+    if limit >= len(data):
+        return len(data)
+    cut = limit
+    # continuation bytes look like 10xxxxxx, a character has at most 3
+    while cut > limit - 3 and cut > 0 and 0x80 <= ord(data[cut]) < 0xC0:
+        cut -= 1
+    return cut
+
+
+class CFishEngine(object):
+    """Runs the cipher in libs/blowfish.so through ctypes.
+
+    The output buffers are allocated once and grown as needed, and the
+    library reports the exact length it wrote so results are copied out
+    exactly once. Since the buffers are shared, an engine must not be used
+    from several threads at the same time.
+    """
     def __init__(self, key):
-        # libs/blowfish.so must exist in the root directory, i.e.
-        # yolobot/libs/blowfish.so
-        self.fish = ctypes.cdll.LoadLibrary('libs/blowfish.so')
-        self.key = key
+        self.fish = ctypes.cdll.LoadLibrary(LIBRARY_PATH)
+        self.fish.blowfish_ctx_new.restype = ctypes.c_void_p
+        self.fish.blowfish_ctx_new.argtypes = [ctypes.c_char_p]
+        self.fish.blowfish_ctx_free.argtypes = [ctypes.c_void_p]
+        for func in (self.fish.encrypt_string_ctx,
+                     self.fish.decrypt_string_ctx):
+            # a str is handed to the library as a pointer to its own memory
+            func.argtypes = [
+                ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_int
+            ]
+            func.restype = ctypes.c_int
+        batch_argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_char_p,
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+        ]
+        self.fish.encrypt_batch_ctx.argtypes = batch_argtypes
+        self.fish.decrypt_batch_ctx.argtypes = batch_argtypes
+
+        self._output = ctypes.create_string_buffer(1024)
+        self._lengths = (ctypes.c_int * 16)()
+        self._output_lengths = (ctypes.c_int * 16)()
+
+        # The key schedule is built once here and reused for every message
+        self.ctx = self.fish.blowfish_ctx_new(key)
+        if not self.ctx:
+            raise ValueError('A non-empty fish key is required')
+
+    def __del__(self):
+        ctx, self.ctx = getattr(self, 'ctx', None), None
+        if ctx:
+            self.fish.blowfish_ctx_free(ctx)
+
+    def _output_buffer(self, size):
+        """Returns the address of the shared output buffer, growing it to
+        at least `size` bytes first if needed"""
+        if ctypes.sizeof(self._output) < size:
+            self._output = ctypes.create_string_buffer(size * 2)
+        return ctypes.addressof(self._output)
+
+    def _length_arrays(self, count):
+        """Returns the shared input and output length arrays, grown to hold
+        at least `count` items"""
+        if len(self._lengths) < count:
+            self._lengths = (ctypes.c_int * (count * 2))()
+            self._output_lengths = (ctypes.c_int * (count * 2))()
+        return self._lengths, self._output_lengths
 
     def decrypt(self, cipher_text):
-        """Decrypts a given string. Handles filling the buffer."""
-        buffer_size = len(cipher_text) * 2 + 1
-        c_memory_block = ctypes.create_string_buffer(buffer_size)
-        self.fish.decrypt_string(
-            ctypes.c_char_p(self.key),
-            ctypes.c_char_p(cipher_text),
-            c_memory_block,
+        """Decrypts a given string"""
+        output = self._output_buffer((len(cipher_text) + 11) // 12 * 8 + 1)
+        length = self.fish.decrypt_string_ctx(
+            self.ctx,
+            cipher_text,
+            output,
             len(cipher_text)
         )
-        c_memory_block[buffer_size - 1] = '\0'
-        return ctypes.string_at(c_memory_block, buffer_size).strip('\x00')
-
-    def _encrypt(self, plaintext):
-        text_length = len(plaintext)
-        if text_length < 6:
-            buffer_size = text_length * 2 + 1 + (12 - text_length)
-        else:
-            buffer_size = text_length * 2 + 1 + (text_length % 12)
+        return ctypes.string_at(output, length)
 
-        c_memory_block = ctypes.create_string_buffer(buffer_size)
-        self.fish.encrypt_string(
-            ctypes.c_char_p(self.key),
-            ctypes.c_char_p(plaintext),
-            c_memory_block,
+    def encrypt(self, plaintext):
+        """Encrypts a given string, without the '+OK ' prefix"""
+        output = self._output_buffer((len(plaintext) + 7) // 8 * 12 + 1)
+        length = self.fish.encrypt_string_ctx(
+            self.ctx,
+            plaintext,
+            output,
             len(plaintext)
         )
-        c_memory_block[buffer_size - 1] = '\0'
-        return '+OK {}'.format(
-            ctypes.string_at(c_memory_block, buffer_size)
-        ).rstrip('\x00') + '\x00'
+        return ctypes.string_at(output, length)
+
+    def _run_batch(self, func, texts, output_sizes):
+        """Runs one of the batch functions over all the given texts with a
+        single call into the library.
+
+        :param func: encrypt_batch_ctx or decrypt_batch_ctx
+        :param texts: The strings to process
+        :param output_sizes: The output slot size of each string
+        :return: The results, in the same order as `texts`
+        """
+        count = len(texts)
+        lengths, output_lengths = self._length_arrays(count)
+        for i, text in enumerate(texts):
+            lengths[i] = len(text)
+        output = self._output_buffer(sum(output_sizes))
+        func(
+            self.ctx,
+            ''.join(texts),
+            ctypes.addressof(lengths),
+            count,
+            output,
+            ctypes.addressof(output_lengths)
+        )
+
+        results = []
+        for i, output_size in enumerate(output_sizes):
+            results.append(ctypes.string_at(output, output_lengths[i]))
+            output += output_size
+        return results
+
+    def decrypt_many(self, cipher_texts):
+        """Decrypts a list of strings with one call into the library"""
+        if not cipher_texts:
+            return []
+
+        output_sizes = [
+            (len(cipher_text) + 11) // 12 * 8 + 1
+            for cipher_text in cipher_texts
+        ]
+        return self._run_batch(
+            self.fish.decrypt_batch_ctx, cipher_texts, output_sizes
+        )
+
+    def encrypt_many(self, plaintexts):
+        """Encrypts a list of strings with one call into the library"""
+        if not plaintexts:
+            return []
+
+        output_sizes = [(len(text) + 7) // 8 * 12 + 1 for text in plaintexts]
+        return self._run_batch(
+            self.fish.encrypt_batch_ctx, plaintexts, output_sizes
+        )
+
+
+def create_engine(key, engine='auto'):
+    """Builds the cipher engine for the given key.
+
+    :param key: The fish key
+    :param engine: 'c' for libs/blowfish.so, 'numpy' for the pure Python
+    engine in numpyfish, or 'auto' to use the library if it can be loaded and
+    fall back to numpy otherwise
+    """
+    if engine not in ENGINES:
+        raise ValueError('Unknown fish engine: {}'.format(engine))
+
+    if engine == 'c' or (engine == 'auto' and os.path.exists(LIBRARY_PATH)):
+        return CFishEngine(key)
+
+    import numpyfish
+    return numpyfish.NumpyFishEngine(key)
+
+
+class YoloFish(object):
+    def __init__(self, key, engine='auto'):
+        self.key = key
+        self.engine = create_engine(key, engine)
+
+    @metrics.timed('fish')
+    def decrypt(self, cipher_text):
+        """Decrypts a given string"""
+        return self.engine.decrypt(cipher_text)
+
+    @metrics.timed('fish')
+    def decrypt_many(self, cipher_texts):
+        """Decrypts a list of strings in one go"""
+        return self.engine.decrypt_many(cipher_texts)
 
+    def _encrypt(self, plaintext):
+        return '{}{}{}'.format(PREFIX, self.engine.encrypt(plaintext), SUFFIX)
+
+    @metrics.timed('fish')
+    def encrypt_many(self, plaintexts, budget=MAX_PLAINTEXT_LENGTH):
+        """Encrypts a list of strings in one go. Long strings are split the
+        same way `encrypt` splits them, so the result can have more items than
+        `plaintexts`.
+
+        :param budget: The most plaintext bytes a single message can carry
+        """
+        pieces = []
+        for plaintext in plaintexts:
+            pieces.extend(self.split(plaintext, budget))
+
+        return [
+            '{}{}{}'.format(PREFIX, cipher_text, SUFFIX)
+            for cipher_text in self.engine.encrypt_many(pieces)
+        ]
+
+    @staticmethod
+    def split(plaintext, budget=MAX_PLAINTEXT_LENGTH):
+        """Splits text longer than `budget` bytes into pieces of at most that
+        many bytes, in a single pass. Pieces are cut between words and filled
+        up as far as they go, words that don't fit in a piece of their own
+        are cut wherever a UTF-8 character ends.
+
+        :return: The pieces, as UTF-8 encoded strings
+        """
+        data = encode(plaintext)
+        if len(data) <= budget:
+            return [data]
+
+        pieces, piece, length = [], [], 0
+        for word in data.split():
+            while len(word) > budget:
+                # fill what's left of the piece, and start a new one
+                room = budget - length - 1 if piece else budget
+                cut = utf8_boundary(word, room) if room > 0 else 0
+                if not cut and not piece:
+                    # the budget is smaller than a single character
+                    cut = room
+                if cut:
+                    piece.append(word[:cut])
+                    word = word[cut:]
+                pieces.append(' '.join(piece))
+                piece, length = [], 0
+
+            if piece and length + 1 + len(word) > budget:
+                pieces.append(' '.join(piece))
+                piece, length = [], 0
+            length += len(word) + (1 if piece else 0)
+            piece.append(word)
+
+        if piece:
+            pieces.append(' '.join(piece))
+        return pieces
+
+    @metrics.timed('fish')
     def encrypt(self, plaintext):
         """Encrypts a given string"""
-        if len(plaintext) > 300:
-            parts = plaintext.split()
-            pieced_msg, final_messages = [], []
-            for chunk in parts:
-                if len(' '.join(pieced_msg)) + len(chunk) < 300:
-                    pieced_msg.append(chunk)
-                else:
-                    final_messages.append(self._encrypt(' '.join(pieced_msg)))
-                    pieced_msg = [chunk]
-            if pieced_msg:
-                final_messages.append(self._encrypt(' '.join(pieced_msg)))
-            return final_messages
+        data = encode(plaintext)
+        if len(data) > MAX_PLAINTEXT_LENGTH:
+            return self.encrypt_many([data])
         else:
-            return self._encrypt(plaintext)
+            return self._encrypt(data)
+
+
+class FishKeyring(object):
+    """Looks up the fish key of a channel and hands out a ready to use
+    YoloFish for it.
+
+    At most `max_contexts` YoloFish instances are kept around, the least
+    recently used one is dropped (and its key schedule freed) when another key
+    is needed. Channels sharing a key share its instance.
+    """
+    def __init__(self, default_key=None, channel_keys=None, max_contexts=32,
+                 engine='auto'):
+        """
+        :param default_key: The key used for channels without their own key
+        :param channel_keys: Maps channel names, with or without the leading
+        '#', to their key
+        :param max_contexts: How many keyed instances to keep around
+        :param engine: The engine passed on to YoloFish
+        """
+        self.default_key = default_key
+        self.channel_keys = {}
+        for channel, key in (channel_keys or {}).items():
+            if not channel.startswith('#'):
+                channel = '#' + channel
+            self.channel_keys[channel.lower()] = key
+        self.max_contexts = max(1, max_contexts)
+        self.engine = engine
+        self._contexts = collections.OrderedDict()
+
+    def key_for(self, target):
+        """Returns the key for the given channel, or None if there is none"""
+        return self.channel_keys.get(target.lower(), self.default_key)
+
+    def get(self, target):
+        """Returns the YoloFish for the given channel, or None if the channel
+        has no key"""
+        key = self.key_for(target)
+        if not key:
+            return None
+
+        fish = self._contexts.pop(key, None)
+        if fish is None:
+            fish = YoloFish(key, self.engine)
+            while len(self._contexts) >= self.max_contexts:
+                self._contexts.popitem(last=False)
+        self._contexts[key] = fish
+        return fish